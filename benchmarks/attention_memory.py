@@ -0,0 +1,85 @@
+"""Peak memory and time of full vs chunked attention at a given resolution.
+
+Times the largest attention layers of the pipeline on their own: the first
+UNet SpatialTransformer (self-attention over every latent pixel) and the VAE
+AttentionBlock. Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/attention_memory.py --H 768 --W 768 --chunk_size 1024
+"""
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from stable_diffusion_tf.autoencoder_kl import AttentionBlock
+from stable_diffusion_tf.diffusion_model import SpatialTransformer
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument("--H", type=int, default=512, help="image height, in pixels")
+parser.add_argument("--W", type=int, default=512, help="image width, in pixels")
+parser.add_argument(
+    "--chunk_size", type=int, default=1024, help="query/key chunk size"
+)
+parser.add_argument(
+    "--batch_size", type=int, default=2, help="UNet batch (2 for one image with guidance)"
+)
+
+args = parser.parse_args()
+
+
+def memory_info():
+    try:
+        return tf.config.experimental.get_memory_info("CPU:0")
+    except (ValueError, tf.errors.OpError):
+        return None
+
+
+def measure(layer, inputs):
+    fn = tf.function(layer)
+    fn(inputs)  # warm-up / tracing
+    try:
+        tf.config.experimental.reset_memory_stats("CPU:0")
+    except (ValueError, tf.errors.OpError):
+        pass
+    before = memory_info()
+    start = time.perf_counter()
+    out = fn(inputs).numpy()
+    elapsed = time.perf_counter() - start
+    after = memory_info()
+    peak = None if before is None else after["peak"] - before["current"]
+    return out, elapsed, peak
+
+
+def fmt_bytes(n):
+    return "n/a" if n is None else f"{n / 2**20:.0f} MiB"
+
+
+def compare(name, make_layer, inputs):
+    full_layer, chunked_layer = make_layer(None), make_layer(args.chunk_size)
+    full_layer(inputs)
+    chunked_layer(inputs)
+    chunked_layer.set_weights(full_layer.get_weights())
+
+    full, full_time, full_peak = measure(full_layer, inputs)
+    chunked, chunked_time, chunked_peak = measure(chunked_layer, inputs)
+    print(name)
+    print(f"  full    : {full_time:7.3f} s  peak {fmt_bytes(full_peak)}")
+    print(f"  chunked : {chunked_time:7.3f} s  peak {fmt_bytes(chunked_peak)}")
+    print(f"  max abs diff {np.abs(full - chunked).max():.2e}")
+
+
+n_h, n_w = args.H // 8, args.W // 8
+print(f"{args.H}x{args.W}: {n_h * n_w} latent tokens, chunk size {args.chunk_size}")
+
+x = tf.random.normal((args.batch_size, n_h, n_w, 320), seed=0)
+context = tf.random.normal((args.batch_size, 77, 768), seed=1)
+compare(
+    "UNet SpatialTransformer(320)",
+    lambda chunk: SpatialTransformer(320, 8, 40, chunk),
+    [x, context],
+)
+
+x = tf.random.normal((1, n_h, n_w, 512), seed=2)
+compare("VAE AttentionBlock(512)", lambda chunk: AttentionBlock(512, chunk), x)
@@ -0,0 +1,84 @@
+"""Throughput of generate_batch against one generate_from_seed call per request,
+for requests with different prompts, seeds and guidance scales.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/batch_generation.py --H 256 --W 256 --batch_sizes 1 2 4
+"""
+import argparse
+import time
+
+import numpy as np
+
+from stable_diffusion_tf.stable_diffusion import GenerationRequest, StableDiffusion
+
+PROMPTS = [
+    "a photograph of an astronaut riding a horse",
+    "a watercolor painting of a lighthouse",
+    "a red sports car parked on a street",
+    "a bowl of fruit on a wooden table",
+]
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument("--H", type=int, default=256, help="image height, in pixels")
+parser.add_argument("--W", type=int, default=256, help="image width, in pixels")
+parser.add_argument("--steps", type=int, default=10, help="number of sampling steps")
+parser.add_argument(
+    "--batch_sizes", type=int, nargs="+", default=[1, 2, 4], help="batch sizes to compare"
+)
+parser.add_argument(
+    "--weights",
+    default=False,
+    action="store_true",
+    help="download the real weights instead of using random ones",
+)
+
+args = parser.parse_args()
+
+generator = StableDiffusion(
+    img_height=args.H, img_width=args.W, download_weights=args.weights
+)
+
+
+def make_requests(n):
+    return [
+        GenerationRequest(
+            PROMPTS[i % len(PROMPTS)],
+            seed=i,
+            unconditional_guidance_scale=5.0 + i % 4,
+        )
+        for i in range(n)
+    ]
+
+
+def sequential(requests):
+    return [
+        generator.generate_from_seed(
+            r.prompt,
+            negative_prompt=r.negative_prompt,
+            num_steps=args.steps,
+            unconditional_guidance_scale=r.unconditional_guidance_scale,
+            seed=r.seed,
+        )[0][0]
+        for r in requests
+    ]
+
+
+def batched(requests):
+    return generator.generate_batch(requests, num_steps=args.steps)
+
+
+batched(make_requests(1))  # warm-up: load weights and trace the models
+
+print(f"{'batch':>6} {'sequential (s)':>15} {'batched (s)':>12} {'img/s gain':>11} {'max diff':>9}")
+for n in args.batch_sizes:
+    requests = make_requests(n)
+    start = time.perf_counter()
+    seq = sequential(requests)
+    seq_time = time.perf_counter() - start
+    start = time.perf_counter()
+    bat = batched(requests)
+    bat_time = time.perf_counter() - start
+    diff = max(np.abs(a.astype(np.int32) - b).max() for a, b in zip(seq, bat))
+    print(f"{n:>6} {seq_time:>15.2f} {bat_time:>12.2f} {seq_time / bat_time:>10.2f}x {diff:>9}")
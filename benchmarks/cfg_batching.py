@@ -0,0 +1,62 @@
+"""Per-step UNet time with and without batched classifier-free guidance.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/cfg_batching.py --H 256 --W 256
+"""
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from stable_diffusion_tf.stable_diffusion import StableDiffusion
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument("--H", type=int, default=256, help="image height, in pixels")
+parser.add_argument("--W", type=int, default=256, help="image width, in pixels")
+parser.add_argument(
+    "--batch_sizes", type=int, nargs="+", default=[1, 2, 4], help="batch sizes to time"
+)
+parser.add_argument("--steps", type=int, default=5, help="timed steps per setting")
+parser.add_argument(
+    "--weights",
+    default=False,
+    action="store_true",
+    help="download the real weights instead of using random ones",
+)
+
+args = parser.parse_args()
+
+with tf.device("/CPU:0"):
+    generator = StableDiffusion(
+        img_height=args.H, img_width=args.W, download_weights=args.weights
+    )
+    n_h, n_w = args.H // 8, args.W // 8
+
+    print(f"{'batch':>5} {'two passes (s)':>15} {'one pass (s)':>13} {'speedup':>8} {'max diff':>9}")
+    for batch_size in args.batch_sizes:
+        latent = tf.random.normal((batch_size, n_h, n_w, 4), seed=0)
+        context = tf.random.normal((batch_size, 77, 768), seed=1)
+        unconditional_context = tf.random.normal((batch_size, 77, 768), seed=2)
+
+        results = {}
+        timings = {}
+        for batch_cfg in (False, True):
+            generator.batch_cfg = batch_cfg
+            # Warm up so that tracing is not part of the measurement
+            generator.get_model_output(latent, 981, context, unconditional_context, 7.5, batch_size)
+            start = time.perf_counter()
+            for _ in range(args.steps):
+                out = generator.get_model_output(
+                    latent, 981, context, unconditional_context, 7.5, batch_size
+                )
+            timings[batch_cfg] = (time.perf_counter() - start) / args.steps
+            results[batch_cfg] = np.asarray(out)
+
+        diff = np.abs(results[True] - results[False]).max()
+        print(
+            f"{batch_size:>5} {timings[False]:>15.3f} {timings[True]:>13.3f} "
+            f"{timings[False] / timings[True]:>7.2f}x {diff:>9.2e}"
+        )
@@ -0,0 +1,93 @@
+"""Parity and timing of the compiled DDIM sampler against the eager loop.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/compiled_sampler.py --H 128 --W 128 --steps 10
+
+Exits with a non-zero status if the compiled sampler drifts from the eager
+reference by more than ``--tolerance``.
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from stable_diffusion_tf.schedulers import get_schedule
+from stable_diffusion_tf.stable_diffusion import StableDiffusion
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument("--H", type=int, default=128, help="image height, in pixels")
+parser.add_argument("--W", type=int, default=128, help="image width, in pixels")
+parser.add_argument("--steps", type=int, default=10, help="number of ddim sampling steps")
+parser.add_argument(
+    "--tolerance", type=float, default=1e-3, help="max allowed mean abs difference"
+)
+parser.add_argument(
+    "--weights",
+    default=False,
+    action="store_true",
+    help="download the real weights instead of using random ones",
+)
+
+args = parser.parse_args()
+
+generator = StableDiffusion(
+    img_height=args.H, img_width=args.W, download_weights=args.weights
+)
+n_h, n_w = args.H // 8, args.W // 8
+
+noise = tf.random.normal((1, n_h, n_w, 4), seed=0)
+context = tf.random.normal((1, 77, 768), seed=1)
+unconditional_context = tf.random.normal((1, 77, 768), seed=2)
+schedule = get_schedule(args.steps)
+
+
+def run_eager():
+    latent = noise
+    for index, timestep in list(enumerate(schedule.timesteps))[::-1]:
+        e_t = generator.get_model_output(
+            latent, timestep, context, unconditional_context, 7.5, 1
+        )
+        latent, _ = generator.get_x_prev_and_pred_x0(
+            latent, e_t, index, schedule.alphas[index], schedule.alphas_prev[index]
+        )
+    return np.asarray(latent)
+
+
+def run_compiled(jit_compile):
+    latent = generator.sample_compiled(
+        noise,
+        schedule,
+        context,
+        unconditional_context,
+        7.5,
+        jit_compile=jit_compile,
+    )
+    return latent.numpy()
+
+
+def timed(fn, *fn_args):
+    fn(*fn_args)  # warm-up / tracing
+    start = time.perf_counter()
+    out = fn(*fn_args)
+    return out, time.perf_counter() - start
+
+
+reference, eager_time = timed(run_eager)
+print(f"eager       : {eager_time:8.3f} s ({eager_time / args.steps:.3f} s/step)")
+
+failed = False
+for jit_compile in (False, True):
+    out, compiled_time = timed(run_compiled, jit_compile)
+    diff = np.abs(out - reference)
+    print(
+        f"jit={str(jit_compile):5} : {compiled_time:8.3f} s ({compiled_time / args.steps:.3f} s/step)"
+        f"  speedup {eager_time / compiled_time:.2f}x"
+        f"  mean diff {diff.mean():.2e}  max diff {diff.max():.2e}"
+    )
+    failed = failed or diff.mean() > args.tolerance
+
+sys.exit(1 if failed else 0)
@@ -0,0 +1,79 @@
+"""Cost of writing generated images on the critical path: saving each batch
+synchronously against handing it to an ImageWriter while the next batch is
+generated. The next batch is stood in for by a sleep of --busy seconds.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/image_output.py --H 512 --W 512 --batch_size 4 --formats PNG JPEG WEBP
+"""
+import argparse
+import time
+
+import numpy as np
+
+from stable_diffusion_tf.output import ImageWriter, encode_image
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--H", type=int, default=512, help="image height, in pixels")
+    parser.add_argument("--W", type=int, default=512, help="image width, in pixels")
+    parser.add_argument("--batch_size", type=int, default=4, help="images per batch")
+    parser.add_argument("--batches", type=int, default=4, help="batches per run")
+    parser.add_argument(
+        "--busy", type=float, default=0.5, help="seconds of generation per batch"
+    )
+    parser.add_argument(
+        "--formats", nargs="+", default=["PNG", "JPEG", "WEBP"], help="formats to compare"
+    )
+    parser.add_argument("--workers", type=int, default=None, help="pool size")
+    parser.add_argument(
+        "--processes",
+        default=False,
+        action="store_true",
+        help="encode in a process pool instead of threads",
+    )
+
+    args = parser.parse_args()
+
+    # Smooth gradients plus noise, to compress roughly like a real image
+    rng = np.random.RandomState(0)
+    y, x = np.mgrid[: args.H, : args.W]
+    base = np.stack([x * 255 / args.W, y * 255 / args.H, (x + y) * 127 / (args.H + args.W)], -1)
+    images = [
+        np.clip(base + rng.normal(0, 8, base.shape), 0, 255).astype("uint8")
+        for _ in range(args.batch_size)
+    ]
+    metadata = {"prompt": "a photograph of an astronaut riding a horse", "seed": 0, "steps": 25}
+
+    print(f"{'format':>6} {'sync (s)':>9} {'async (s)':>10} {'blocked (ms)':>13} {'KiB/image':>10}")
+    for format in args.formats:
+        start = time.perf_counter()
+        for _ in range(args.batches):
+            time.sleep(args.busy)
+            sizes = [len(encode_image(image, format, metadata)) for image in images]
+        sync_time = time.perf_counter() - start
+
+        with ImageWriter(args.workers, args.processes, format) as writer:
+            writer.submit(images[0]).result()  # start the workers
+            start = time.perf_counter()
+            blocked = 0.0
+            futures = []
+            for _ in range(args.batches):
+                time.sleep(args.busy)
+                submit_start = time.perf_counter()
+                futures += writer.submit_batch(images, metadata=[metadata] * len(images))
+                blocked += time.perf_counter() - submit_start
+            for future in futures:
+                future.result()
+            async_time = time.perf_counter() - start
+
+        print(
+            f"{format:>6} {sync_time:>9.2f} {async_time:>10.2f}"
+            f" {blocked / args.batches * 1000:>13.2f} {np.mean(sizes) / 1024:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
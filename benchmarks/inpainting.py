@@ -0,0 +1,112 @@
+"""Time and output of latent-space inpainting against the pixel-space
+feedback loop, which runs the VAE up to four times per step.
+
+Without --image/--mask a synthetic source and a mask keeping its left half are
+used. Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/inpainting.py --H 256 --W 256 --steps 10
+
+With ``--weights`` and ``--output_dir`` both results are saved as
+``pixel.png`` and ``latent.png`` so quality can be compared side by side.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from stable_diffusion_tf.stable_diffusion import StableDiffusion
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument(
+    "--prompt",
+    type=str,
+    default="a red sports car parked on a street",
+    help="the prompt to render",
+)
+parser.add_argument("--image", type=str, default=None, help="source image path")
+parser.add_argument(
+    "--mask", type=str, default=None, help="mask path, white keeps the source"
+)
+parser.add_argument("--H", type=int, default=256, help="image height, in pixels")
+parser.add_argument("--W", type=int, default=256, help="image width, in pixels")
+parser.add_argument("--steps", type=int, default=10, help="number of sampling steps")
+parser.add_argument(
+    "--strength", type=float, default=0.8, help="how much of the schedule to run"
+)
+parser.add_argument("--seed", type=int, default=0, help="seed shared by both runs")
+parser.add_argument("--output_dir", type=str, default=None, help="where to save images")
+parser.add_argument(
+    "--weights",
+    default=False,
+    action="store_true",
+    help="download the real weights instead of using random ones",
+)
+
+args = parser.parse_args()
+
+tmp_dir = tempfile.mkdtemp()
+image_path, mask_path = args.image, args.mask
+if image_path is None:
+    rng = np.random.default_rng(args.seed)
+    gradient = np.linspace(0, 255, args.W)[None, :, None] * np.ones((args.H, 1, 3))
+    source = np.clip(gradient + rng.normal(0, 20, gradient.shape), 0, 255)
+    image_path = os.path.join(tmp_dir, "image.png")
+    Image.fromarray(source.astype("uint8")).save(image_path)
+if mask_path is None:
+    mask = np.zeros((args.H, args.W, 3), dtype="uint8")
+    mask[:, : args.W // 2] = 255
+    mask_path = os.path.join(tmp_dir, "mask.png")
+    Image.fromarray(mask).save(mask_path)
+
+source = np.array(
+    Image.open(image_path).resize((args.W, args.H)), dtype=np.float32
+)[..., :3]
+keep = np.array(Image.open(mask_path).resize((args.W, args.H)), dtype=np.float32)[
+    ..., :3
+] / 255.0
+
+generator = StableDiffusion(
+    img_height=args.H, img_width=args.W, download_weights=args.weights
+)
+if args.output_dir:
+    os.makedirs(args.output_dir, exist_ok=True)
+
+
+def run(mode):
+    return generator.generate_from_seed(
+        args.prompt,
+        num_steps=args.steps,
+        seed=args.seed,
+        input_image=image_path,
+        input_mask=mask_path,
+        input_image_strength=args.strength,
+        feedback=mode == "pixel",
+        inpaint_mode=mode,
+    )[0][0]
+
+
+try:
+    run("latent")  # warm-up: load weights and trace the models
+    results = {}
+    print(f"{'mode':>8} {'seconds':>8} {'kept region err':>16}")
+    for mode in ("pixel", "latent"):
+        start = time.perf_counter()
+        img = run(mode)
+        elapsed = time.perf_counter() - start
+        results[mode] = img.astype(np.float32)
+        # How far the output drifts from the source where the mask keeps it
+        kept_err = (np.abs(results[mode] - source) * keep).sum() / max(keep.sum(), 1)
+        print(f"{mode:>8} {elapsed:>8.2f} {kept_err:>16.2f}")
+        if args.output_dir:
+            Image.fromarray(img).save(os.path.join(args.output_dir, f"{mode}.png"))
+
+    edit = 1 - keep
+    diff = (np.abs(results["pixel"] - results["latent"]) * edit).sum() / max(edit.sum(), 1)
+    print(f"mean abs diff between modes in the inpainted region: {diff:.2f}")
+finally:
+    shutil.rmtree(tmp_dir)
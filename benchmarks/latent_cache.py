@@ -0,0 +1,55 @@
+"""Time to get the starting latent of a repeated img2img source image, with
+a cold and a warm latent cache.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/latent_cache.py --H 512 --W 512
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from stable_diffusion_tf.stable_diffusion import StableDiffusion
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument("--H", type=int, default=512, help="image height, in pixels")
+parser.add_argument("--W", type=int, default=512, help="image width, in pixels")
+parser.add_argument("--repeats", type=int, default=5, help="timed warm lookups")
+parser.add_argument(
+    "--weights",
+    default=False,
+    action="store_true",
+    help="download the real weights instead of using random ones",
+)
+
+args = parser.parse_args()
+
+generator = StableDiffusion(
+    img_height=args.H, img_width=args.W, download_weights=args.weights
+)
+
+with tempfile.TemporaryDirectory() as tmp:
+    # A source larger than the target, so every miss also pays for the resize
+    path = os.path.join(tmp, "source.png")
+    pixels = np.random.RandomState(0).randint(0, 256, (args.H * 2, args.W * 2, 3))
+    Image.fromarray(pixels.astype("uint8")).save(path)
+
+    generator.encode(np.zeros((1, args.H, args.W, 3), np.float32))  # warm-up / tracing
+
+    start = time.perf_counter()
+    cold = generator.image_latent(path)
+    cold_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        warm = generator.image_latent(path)
+    warm_time = (time.perf_counter() - start) / args.repeats
+
+print(f"cold (decode + resize + encode): {cold_time * 1000:9.2f} ms")
+print(f"warm (hash + lookup)           : {warm_time * 1000:9.2f} ms  ({cold_time / warm_time:.0f}x faster)")
+print(f"max diff: {np.abs(np.asarray(cold) - np.asarray(warm)).max()}, {generator.latent_cache.stats()}")
@@ -0,0 +1,70 @@
+"""Source image preprocessing: one image at a time through the original PIL
+block against preprocessing.image_arrays, which decodes in a thread pool, for
+encoded files and for in-memory arrays already at the target size.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/preprocessing.py --H 512 --W 512 --images 8
+"""
+import argparse
+import io
+import time
+
+import numpy as np
+from PIL import Image
+
+from stable_diffusion_tf.preprocessing import image_arrays
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument("--H", type=int, default=512, help="image height, in pixels")
+parser.add_argument("--W", type=int, default=512, help="image width, in pixels")
+parser.add_argument("--images", type=int, default=8, help="images per batch")
+parser.add_argument("--scale", type=float, default=2.0, help="source size / target size")
+parser.add_argument("--format", default="JPEG", help="encoding of the source files")
+parser.add_argument("--workers", type=int, default=None, help="thread pool size")
+parser.add_argument("--repeats", type=int, default=3, help="timed runs per method")
+
+args = parser.parse_args()
+
+rng = np.random.RandomState(0)
+size = (int(args.H * args.scale), int(args.W * args.scale))
+uploads = []
+for _ in range(args.images):
+    buffer = io.BytesIO()
+    pixels = rng.randint(0, 256, size + (3,)).astype("uint8")
+    Image.fromarray(pixels).save(buffer, format=args.format)
+    uploads.append(buffer.getvalue())
+arrays = [rng.randint(0, 256, (args.H, args.W, 3)).astype("uint8") for _ in range(args.images)]
+
+
+def original(images):
+    # The block formerly repeated in StableDiffusion, from a temp file or array
+    out = []
+    for image in images:
+        if isinstance(image, bytes):
+            image = Image.open(io.BytesIO(image))
+        else:
+            image = Image.fromarray(image)
+        image = image.resize((args.W, args.H))
+        out.append(np.array(image, dtype=np.float32)[None, ..., :3])
+    return np.concatenate(out)
+
+
+def timed(fn, images):
+    fn(images)  # warm-up
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        out = fn(images)
+    return out, (time.perf_counter() - start) / args.repeats
+
+
+print(f"{'input':>8} {'original (ms)':>14} {'pipeline (ms)':>14} {'speed-up':>9} {'max diff':>9}")
+for name, images in [(args.format.lower(), uploads), ("array", arrays)]:
+    reference, reference_time = timed(original, images)
+    out, pipeline_time = timed(lambda x: image_arrays(x, args.H, args.W, args.workers), images)
+    diff = np.abs(reference - out).max()
+    print(
+        f"{name:>8} {reference_time * 1000:>14.1f} {pipeline_time * 1000:>14.1f}"
+        f" {reference_time / pipeline_time:>8.2f}x {diff:>9.1f}"
+    )
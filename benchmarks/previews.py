@@ -0,0 +1,53 @@
+"""Cost of a per-step preview: the linear latent-to-RGB approximation against a
+full VAE decode.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/previews.py --H 512 --W 512
+"""
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from stable_diffusion_tf.preview import approximate_decode
+from stable_diffusion_tf.stable_diffusion import StableDiffusion
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument("--H", type=int, default=512, help="image height, in pixels")
+parser.add_argument("--W", type=int, default=512, help="image width, in pixels")
+parser.add_argument("--repeats", type=int, default=5, help="timed runs per method")
+parser.add_argument(
+    "--weights",
+    default=False,
+    action="store_true",
+    help="download the real weights instead of using random ones",
+)
+
+args = parser.parse_args()
+
+generator = StableDiffusion(
+    img_height=args.H, img_width=args.W, download_weights=args.weights
+)
+latent = tf.random.normal((1, args.H // 8, args.W // 8, 4), seed=0)
+
+
+def timed(fn):
+    fn(latent)  # warm-up / tracing
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        out = fn(latent)
+    return np.asarray(out), (time.perf_counter() - start) / args.repeats
+
+
+full, full_time = timed(generator.decode_latent)
+approx, approx_time = timed(approximate_decode)
+
+print(f"full decode : {full_time * 1000:9.2f} ms")
+print(f"approximate : {approx_time * 1000:9.2f} ms  ({full_time / approx_time:.0f}x faster)")
+if args.weights:
+    # Only meaningful with real weights, random ones decode to noise
+    diff = np.abs(full.astype(np.float32) - approx.astype(np.float32))
+    print(f"mean abs diff to the full decode: {diff.mean():.1f} / 255")
@@ -0,0 +1,69 @@
+"""Time per image for each scheduler at a few step counts.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/schedulers.py --weights --output_dir sched_out
+
+With ``--weights`` and ``--output_dir`` the images are saved as
+``<scheduler>_<steps>.png`` so quality can be compared side by side.
+"""
+import argparse
+import os
+import time
+
+from PIL import Image
+
+from stable_diffusion_tf.schedulers import SCHEDULERS, get_scheduler
+from stable_diffusion_tf.stable_diffusion import StableDiffusion
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument(
+    "--prompt",
+    type=str,
+    default="a photograph of an astronaut riding a horse",
+    help="the prompt to render",
+)
+parser.add_argument("--H", type=int, default=512, help="image height, in pixels")
+parser.add_argument("--W", type=int, default=512, help="image width, in pixels")
+parser.add_argument(
+    "--schedulers",
+    nargs="+",
+    default=sorted(SCHEDULERS),
+    choices=sorted(SCHEDULERS),
+    help="schedulers to compare",
+)
+parser.add_argument(
+    "--steps", type=int, nargs="+", default=[15, 20, 50], help="step counts to compare"
+)
+parser.add_argument("--seed", type=int, default=0, help="seed shared by all runs")
+parser.add_argument("--output_dir", type=str, default=None, help="where to save images")
+parser.add_argument(
+    "--weights",
+    default=False,
+    action="store_true",
+    help="download the real weights instead of using random ones",
+)
+
+args = parser.parse_args()
+
+generator = StableDiffusion(
+    img_height=args.H, img_width=args.W, download_weights=args.weights
+)
+if args.output_dir:
+    os.makedirs(args.output_dir, exist_ok=True)
+
+print(f"{'scheduler':>10} {'steps':>6} {'seconds':>8}")
+for name in args.schedulers:
+    generator.scheduler = get_scheduler(name)
+    for num_steps in args.steps:
+        start = time.perf_counter()
+        img = generator.generate_from_seed(
+            args.prompt, num_steps=num_steps, seed=args.seed
+        )
+        elapsed = time.perf_counter() - start
+        print(f"{name:>10} {num_steps:>6} {elapsed:>8.2f}")
+        if args.output_dir:
+            Image.fromarray(img[0][0]).save(
+                os.path.join(args.output_dir, f"{name}_{num_steps}.png")
+            )
@@ -0,0 +1,125 @@
+"""Load test of the batching servers: client threads submit requests at a
+fixed rate, then throughput, batch sizes and latency are reported for each
+server and max batch size. With --img2img_every N, every Nth request is a
+short img2img job, the mixed workload continuous batching is meant for. For
+the pipeline server, per-stage time, utilization and queue depth follow.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/server.py --H 64 --W 64 --steps 5 --requests 8 --img2img_every 2
+"""
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from stable_diffusion_tf.server import (
+    BatchingServer,
+    ContinuousBatchingServer,
+    PipelineServer,
+)
+from stable_diffusion_tf.stable_diffusion import StableDiffusion
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument("--H", type=int, default=64, help="image height, in pixels")
+parser.add_argument("--W", type=int, default=64, help="image width, in pixels")
+parser.add_argument("--steps", type=int, default=5, help="number of sampling steps")
+parser.add_argument("--requests", type=int, default=8, help="requests per run")
+parser.add_argument("--clients", type=int, default=4, help="client threads")
+parser.add_argument(
+    "--interval", type=float, default=0.0, help="seconds between a client's requests"
+)
+parser.add_argument(
+    "--max_batch_sizes", type=int, nargs="+", default=[1, 4], help="server batch sizes"
+)
+parser.add_argument(
+    "--max_wait", type=float, default=0.05, help="seconds a request may wait for a batch"
+)
+parser.add_argument(
+    "--servers",
+    nargs="+",
+    default=["batching", "continuous"],
+    choices=["batching", "continuous", "pipeline"],
+    help="servers to compare",
+)
+parser.add_argument(
+    "--img2img_every",
+    type=int,
+    default=0,
+    help="make every Nth request img2img (continuous server only, 0: never)",
+)
+parser.add_argument(
+    "--strength", type=float, default=0.3, help="input_image_strength of img2img requests"
+)
+parser.add_argument(
+    "--weights",
+    default=False,
+    action="store_true",
+    help="download the real weights instead of using random ones",
+)
+
+args = parser.parse_args()
+
+generator = StableDiffusion(
+    img_height=args.H, img_width=args.W, download_weights=args.weights
+)
+generator.generate_batch([{"prompt": "warm-up", "seed": 0}], num_steps=1)
+
+
+SERVERS = {
+    "batching": BatchingServer,
+    "continuous": ContinuousBatchingServer,
+    "pipeline": PipelineServer,
+}
+source = np.linspace(0, 255, args.W)[None, :, None] * np.ones((args.H, 1, 3))
+source = source.astype("uint8")
+
+
+def client(server, index, futures):
+    for i in range(index, args.requests, args.clients):
+        kwargs = {}
+        if isinstance(server, ContinuousBatchingServer) and args.img2img_every and i % args.img2img_every == 0:
+            kwargs = {"input_image": source, "input_image_strength": args.strength}
+        futures.append(server.submit(f"request {i}", seed=i, num_steps=args.steps, **kwargs))
+        time.sleep(args.interval)
+
+
+stage_metrics = []
+print(
+    f"{'server':>10} {'max batch':>9} {'seconds':>8} {'img/s':>6} {'mean batch':>10}"
+    f" {'queue wait':>10} {'p50 (s)':>8} {'p95 (s)':>8}"
+)
+for name, max_batch_size in [(n, b) for n in args.servers for b in args.max_batch_sizes]:
+    futures = []
+    start = time.perf_counter()
+    with SERVERS[name](generator, max_batch_size, args.max_wait) as server:
+        clients = [
+            threading.Thread(target=client, args=(server, i, futures))
+            for i in range(args.clients)
+        ]
+        for t in clients:
+            t.start()
+        for t in clients:
+            t.join()
+        for future in futures:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    m = server.metrics()
+    print(
+        f"{name:>10} {max_batch_size:>9} {elapsed:>8.2f} {args.requests / elapsed:>6.2f}"
+        f" {m['mean_batch_size']:>10.2f} {m['mean_queue_wait']:>10.2f}"
+        f" {m['latency_p50']:>8.2f} {m['latency_p95']:>8.2f}"
+    )
+    if "stages" in m:
+        stage_metrics.append((name, max_batch_size, m["stages"]))
+
+for name, max_batch_size, stages in stage_metrics:
+    print(f"\n{name} (max batch {max_batch_size}) {'s/item':>8} {'busy':>6} {'queued':>7}")
+    for stage, values in stages.items():
+        print(
+            f"{stage:>24} {values['mean_time']:>8.3f} {values['utilization']:>6.0%}"
+            f" {values['queue_depth']:>7}"
+        )
@@ -0,0 +1,80 @@
+"""Per-component startup time: model build, .h5 load and converted weights load.
+
+Without --weights, random weights are written to a temporary directory in
+both formats, so the comparison runs offline. With --weights, the real .h5
+files are used and the converted copies go to --weights_dir. Run from the
+repository root:
+
+    PYTHONPATH=. python benchmarks/startup.py
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from stable_diffusion_tf.stable_diffusion import COMPONENTS, build_component
+from stable_diffusion_tf.weights import (
+    load_flat_weights,
+    load_weights,
+    save_flat_weights,
+)
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument(
+    "--components",
+    nargs="+",
+    default=list(COMPONENTS),
+    choices=list(COMPONENTS),
+    help="components to time",
+)
+parser.add_argument(
+    "--weights",
+    default=False,
+    action="store_true",
+    help="use the real .h5 weights instead of random ones",
+)
+parser.add_argument(
+    "--weights_dir",
+    type=str,
+    default=None,
+    help="where converted weights go with --weights (default: a temporary directory)",
+)
+
+args = parser.parse_args()
+
+tmp_dir = tempfile.mkdtemp()
+weights_dir = args.weights_dir or os.path.join(tmp_dir, "flat")
+
+
+def timed(fn, *fn_args):
+    start = time.perf_counter()
+    fn(*fn_args)
+    return time.perf_counter() - start
+
+
+print(f"{'component':>16} {'build (s)':>10} {'h5 (s)':>8} {'flat (s)':>9} {'size':>9}")
+try:
+    for name in args.components:
+        start = time.perf_counter()
+        model = build_component(name, 512, 512)
+        build_time = time.perf_counter() - start
+
+        if args.weights:
+            if os.path.exists(os.path.join(weights_dir, name + ".json")):
+                os.remove(os.path.join(weights_dir, name + ".json"))
+            # Loads the .h5 and writes the converted copy
+            h5_time = timed(load_weights, model, name, weights_dir)
+        else:
+            h5_path = os.path.join(tmp_dir, name + ".h5")
+            model.save_weights(h5_path)
+            save_flat_weights(model, weights_dir, name)
+            h5_time = timed(model.load_weights, h5_path)
+        flat_time = timed(load_flat_weights, model, weights_dir, name)
+
+        size = os.path.getsize(os.path.join(weights_dir, name + ".npy")) / 2**20
+        print(f"{name:>16} {build_time:>10.2f} {h5_time:>8.2f} {flat_time:>9.2f} {size:>5.0f} MiB")
+        del model
+finally:
+    shutil.rmtree(tmp_dir)
@@ -0,0 +1,122 @@
+"""Peak memory, time and error of tiled VAE decoding/encoding against the
+monolithic decoder and encoder, then a tiled pass at a second size whose
+tiles have another shape, as when serving several resolutions, and a tile
+size no larger than the overlap, which must be rejected.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/tiled_vae.py --H 256 --W 256 --tile_size 16
+"""
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from stable_diffusion_tf.stable_diffusion import StableDiffusion
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument("--H", type=int, default=256, help="image height, in pixels")
+parser.add_argument("--W", type=int, default=256, help="image width, in pixels")
+parser.add_argument(
+    "--tile_size", type=int, default=16, help="tile size, in latent pixels"
+)
+parser.add_argument(
+    "--overlap", type=int, default=8, help="tile overlap, in latent pixels"
+)
+parser.add_argument(
+    "--part",
+    choices=["decode", "encode", "both"],
+    default="both",
+    help="which half of the VAE to benchmark",
+)
+parser.add_argument(
+    "--weights",
+    default=False,
+    action="store_true",
+    help="download the real weights instead of using random ones",
+)
+
+args = parser.parse_args()
+
+generator = StableDiffusion(
+    img_height=args.H,
+    img_width=args.W,
+    download_weights=args.weights,
+    vae_tile_overlap=args.overlap,
+)
+
+
+def memory_info():
+    try:
+        return tf.config.experimental.get_memory_info("CPU:0")
+    except (ValueError, tf.errors.OpError):
+        return None
+
+
+def timed(fn, *fn_args):
+    fn(*fn_args)  # warm-up / tracing
+    try:
+        tf.config.experimental.reset_memory_stats("CPU:0")
+    except (ValueError, tf.errors.OpError):
+        pass
+    before = memory_info()
+    start = time.perf_counter()
+    out = fn(*fn_args)
+    elapsed = time.perf_counter() - start
+    after = memory_info()
+    # Peak allocation on top of the weights and other live tensors
+    peak = None if before is None else after["peak"] - before["current"]
+    return np.asarray(out), elapsed, peak
+
+
+def fmt_bytes(n):
+    return "n/a" if n is None else f"{n / 2**20:.0f} MiB"
+
+
+def compare(name, fn, x, stats_attr):
+    full, full_time, full_peak = timed(fn, x, None)
+    tiled, tiled_time, tiled_peak = timed(fn, x, args.tile_size)
+
+    print(f"{name}")
+    print(f"  full  : {full_time:7.3f} s  peak {fmt_bytes(full_peak)}")
+    print(f"  tiled : {tiled_time:7.3f} s  peak {fmt_bytes(tiled_peak)}")
+    for tile in getattr(generator, stats_attr):
+        print(
+            f"    tile {tile['box']}: {tile['seconds']:.3f} s"
+            f"  peak {fmt_bytes(tile['peak_bytes'])}"
+        )
+    diff = np.abs(full - tiled)
+    print(
+        f"  mean abs diff {diff.mean():.4f}  max abs diff {diff.max():.4f}"
+        f"  (mean abs value {np.abs(full).mean():.4f})"
+    )
+
+
+# Narrower than one tile, so its tiles differ in shape from the first size's
+narrow = (args.H // 8, max(1, args.tile_size // 2))
+
+if args.part in ("decode", "both"):
+    latent = tf.random.normal((1, args.H // 8, args.W // 8, 4), seed=0)
+    compare("decoder", generator.decode_raw, latent, "last_decode_stats")
+    narrow_latent = tf.random.normal((1,) + narrow + (4,), seed=0)
+    out = generator.decode_raw(narrow_latent, args.tile_size)
+    print(f"  second tile shape: decoded {tuple(narrow_latent.shape)} to {tuple(out.shape)}")
+    try:
+        generator.decode_raw(latent, args.overlap)
+        print("  tile_size == overlap: decoded without an error")
+    except ValueError as e:
+        print(f"  tile_size == overlap: {e}")
+
+if args.part in ("encode", "both"):
+    image = tf.random.uniform((1, args.H, args.W, 3), -1, 1, seed=0)
+    compare("encoder", generator.encode, image, "last_encode_stats")
+    narrow_image = tf.random.uniform((1, narrow[0] * 8, narrow[1] * 8, 3), -1, 1, seed=0)
+    out = generator.encode(narrow_image, args.tile_size)
+    print(f"  second tile shape: encoded {tuple(narrow_image.shape)} to {tuple(out.shape)}")
+    try:
+        generator.encode(image, args.overlap)
+        print("  tile_size == overlap: encoded without an error")
+    except ValueError as e:
+        print(f"  tile_size == overlap: {e}")
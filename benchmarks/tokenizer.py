@@ -0,0 +1,128 @@
+"""Tokenizer construction and encoding time over a prompt corpus, with the
+heap-based BPE merge checked against the original pair-scanning loop.
+
+Without --corpus (one prompt per line) a synthetic corpus is generated. Run
+from the repository root:
+
+    PYTHONPATH=. python benchmarks/tokenizer.py --prompts 5000
+"""
+import argparse
+import random
+import time
+
+import regex as re
+
+from stable_diffusion_tf.clip_tokenizer import (
+    SimpleTokenizer,
+    basic_clean,
+    get_pairs,
+    load_vocab,
+    whitespace_clean,
+)
+
+WORDS = (
+    "a photograph of an astronaut riding horse on the moon, highly detailed "
+    "digital painting trending artstation concept art smooth sharp focus "
+    "illustration by greg rutkowski and alphonse mucha octane render 8k "
+    "cinematic lighting portrait beautiful landscape sunset watercolor "
+    "cyberpunk city night rain neon reflections steampunk airship clouds "
+    "hyperrealistic unreal engine volumetric fog matte painting fantasy castle"
+).split()
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument("--corpus", type=str, default=None, help="file with one prompt per line")
+parser.add_argument("--prompts", type=int, default=5000, help="size of the synthetic corpus")
+parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic corpus")
+
+args = parser.parse_args()
+
+if args.corpus:
+    with open(args.corpus) as f:
+        corpus = [line.strip() for line in f if line.strip()]
+else:
+    rng = random.Random(args.seed)
+
+    def word():
+        # Mostly common prompt words, some made-up ones to exercise long merges
+        if rng.random() < 0.8:
+            return rng.choice(WORDS)
+        return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 14)))
+
+    corpus = [" ".join(word() for _ in range(rng.randint(5, 40))) for _ in range(args.prompts)]
+
+
+def reference_merge(bpe_ranks, token):
+    # The original loop: rescans every pair for the lowest rank on each merge
+    word = tuple(token[:-1]) + (token[-1] + "</w>",)
+    pairs = get_pairs(word)
+    if not pairs:
+        return token + "</w>"
+    while True:
+        bigram = min(pairs, key=lambda pair: bpe_ranks.get(pair, float("inf")))
+        if bigram not in bpe_ranks:
+            break
+        first, second = bigram
+        new_word = []
+        i = 0
+        while i < len(word):
+            try:
+                j = word.index(first, i)
+                new_word.extend(word[i:j])
+                i = j
+            except ValueError:
+                new_word.extend(word[i:])
+                break
+            if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
+                new_word.append(first + second)
+                i += 2
+            else:
+                new_word.append(word[i])
+                i += 1
+        word = tuple(new_word)
+        if len(word) == 1:
+            break
+        pairs = get_pairs(word)
+    return " ".join(word)
+
+
+def timed(fn, *fn_args):
+    start = time.perf_counter()
+    result = fn(*fn_args)
+    return result, time.perf_counter() - start
+
+
+# Construction: the first one parses (or unpickles) the vocab, later ones share it
+load_vocab.cache_clear()
+_, first_init = timed(SimpleTokenizer)
+tokenizer, later_init = timed(SimpleTokenizer)
+print(f"construction: first {first_init * 1000:.1f} ms, later {later_init * 1000:.1f} ms")
+
+# Merge algorithms on every distinct word of the corpus, without caches
+words = sorted(
+    {
+        "".join(tokenizer.byte_encoder[b] for b in token.encode("utf-8"))
+        for text in corpus
+        for token in re.findall(tokenizer.pat, whitespace_clean(basic_clean(text)).lower())
+    }
+)
+reference, reference_time = timed(
+    lambda: [reference_merge(tokenizer.bpe_ranks, w) for w in words]
+)
+heap, heap_time = timed(lambda: [tokenizer._merge(w) for w in words])
+mismatches = sum(a != b for a, b in zip(reference, heap))
+print(
+    f"merge {len(words)} distinct words: reference {reference_time * 1000:.1f} ms,"
+    f" heap {heap_time * 1000:.1f} ms, {mismatches} mismatches"
+)
+
+# encode_batch over the corpus with cold and warm word caches
+fresh = SimpleTokenizer()
+ids, cold_time = timed(fresh.encode_batch, corpus)
+_, warm_time = timed(fresh.encode_batch, corpus)
+print(
+    f"encode_batch {ids.shape} {ids.dtype}: cold {len(corpus) / cold_time:.0f} prompts/s,"
+    f" warm {len(corpus) / warm_time:.0f} prompts/s"
+)
+if mismatches:
+    raise SystemExit("heap merge differs from the reference")
@@ -1,6 +1,6 @@
 import argparse
 from stable_diffusion_tf.stable_diffusion import StableDiffusion
-from PIL import Image
+from stable_diffusion_tf.output import save_image
 
 parser = argparse.ArgumentParser()
 
@@ -52,4 +52,4 @@ img = generator.generate(
     input_image=args.input,
     input_image_strength=0.8
 )
-Image.fromarray(img[0]).save(args.output)
+save_image(img[0], args.output, metadata={"prompt": args.prompt, "input": args.input, "steps": args.steps})
@@ -1,12 +1,17 @@
+import time
+
+import numpy as np
 import tensorflow as tf
 from tensorflow import keras
 
-from .layers import apply_seq, PaddedConv2D
+from .layers import apply_seq, PaddedConv2D, chunked_attention
 
 
 class AttentionBlock(keras.layers.Layer):
-    def __init__(self, channels):
+    def __init__(self, channels, attention_chunk_size=None):
         super().__init__()
+        # Chunk attention over queries and keys once h * w is larger than this
+        self.attention_chunk_size = attention_chunk_size
         self.norm = tf.keras.layers.GroupNormalization(epsilon=1e-5)
         self.q = PaddedConv2D(channels, 1)
         self.k = PaddedConv2D(channels, 1)
@@ -19,6 +24,16 @@ class AttentionBlock(keras.layers.Layer):
 
         # Compute attention
         b, h, w, c = q.shape
+        if self.attention_chunk_size is not None and h * w > self.attention_chunk_size:
+            h_ = chunked_attention(
+                tf.reshape(q, (-1, h * w, c)) * (c ** (-0.5)),
+                tf.reshape(k, (-1, h * w, c)),
+                tf.reshape(v, (-1, h * w, c)),
+                self.attention_chunk_size,
+            )
+            h_ = tf.reshape(h_, (-1, h, w, c))
+            return x + self.proj_out(h_)
+
         q = tf.reshape(q, (-1, h * w, c))  # b,hw,c
         k = keras.layers.Permute((3, 1, 2))(k)
         k = tf.reshape(k, (-1, c, h * w))  # b,c,hw
@@ -56,14 +71,14 @@ class ResnetBlock(keras.layers.Layer):
 
 
 class Decoder(keras.Sequential):
-    def __init__(self):
+    def __init__(self, attention_chunk_size=None):
         super().__init__(
             [
                 keras.layers.Lambda(lambda x: 1 / 0.18215 * x),
                 PaddedConv2D(4, 1),
                 PaddedConv2D(512, 3, padding=1),
                 ResnetBlock(512, 512),
-                AttentionBlock(512),
+                AttentionBlock(512, attention_chunk_size),
                 ResnetBlock(512, 512),
                 ResnetBlock(512, 512),
                 ResnetBlock(512, 512),
@@ -91,7 +106,7 @@ class Decoder(keras.Sequential):
 
 
 class Encoder(keras.Sequential):
-    def __init__(self):
+    def __init__(self, attention_chunk_size=None):
         super().__init__(
             [
                 PaddedConv2D(128, 3, padding=1 ),
@@ -111,7 +126,7 @@ class Encoder(keras.Sequential):
                 ResnetBlock(512, 512),
                 
                 ResnetBlock(512, 512),
-                AttentionBlock(512),
+                AttentionBlock(512, attention_chunk_size),
                 ResnetBlock(512, 512),
                 
                 tf.keras.layers.GroupNormalization(epsilon=1e-5) , 
@@ -122,3 +137,94 @@ class Encoder(keras.Sequential):
             ]
         )
 
+
+
+def _tile_starts(length, tile_size, overlap):
+    if length <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    starts = list(range(0, length - tile_size, stride))
+    return starts + [length - tile_size]
+
+
+def _blend_weights(size, overlap, first, last):
+    # Linear ramps over the overlap so neighbouring tiles cross-fade
+    weights = np.ones(size, dtype="float32")
+    if overlap > 0:
+        ramp = np.arange(1, overlap + 1, dtype="float32") / (overlap + 1)
+        if not first:
+            weights[:overlap] = np.minimum(weights[:overlap], ramp)
+        if not last:
+            weights[-overlap:] = np.minimum(weights[-overlap:], ramp[::-1])
+    return weights
+
+
+def _memory_info():
+    device = "GPU:0" if tf.config.list_logical_devices("GPU") else "CPU:0"
+    try:
+        return device, tf.config.experimental.get_memory_info(device)
+    except (ValueError, tf.errors.OpError):
+        return device, None
+
+
+def apply_tiled(fn, x, tile_size, overlap, scale, stats=None):
+    """Applies fn to overlapping spatial tiles of x and blends the results.
+
+    tile_size and overlap are in pixels of x, and scale is the output/input
+    size ratio of fn (8 for the decoder, 1/8 for the encoder). If stats is a
+    list, one dict per tile is appended with its box, time and the peak device
+    memory allocated on top of what was in use before the tile (None where TF
+    cannot report it).
+    """
+    if not 0 <= overlap < tile_size:
+        raise ValueError(f"Tile overlap must be in [0, tile_size), got {overlap} for tile_size {tile_size}")
+    x = tf.convert_to_tensor(x)
+    b, h, w = x.shape[0], x.shape[1], x.shape[2]
+    out = None
+    total_weight = None
+    ys, xs = _tile_starts(h, tile_size, overlap), _tile_starts(w, tile_size, overlap)
+    for i, y0 in enumerate(ys):
+        for j, x0 in enumerate(xs):
+            th, tw = min(tile_size, h), min(tile_size, w)
+            device, before = _memory_info()
+            try:
+                tf.config.experimental.reset_memory_stats(device)
+            except (ValueError, tf.errors.OpError):
+                pass
+            start = time.perf_counter()
+            tile = np.asarray(fn(x[:, y0 : y0 + th, x0 : x0 + tw]), dtype="float32")
+            elapsed = time.perf_counter() - start
+
+            oy, ox = int(y0 * scale), int(x0 * scale)
+            oh, ow = tile.shape[1], tile.shape[2]
+            o_overlap = int(overlap * scale)
+            weight = np.outer(
+                _blend_weights(oh, o_overlap, i == 0, i == len(ys) - 1),
+                _blend_weights(ow, o_overlap, j == 0, j == len(xs) - 1),
+            )[None, :, :, None]
+            if out is None:
+                out = np.zeros((b, int(h * scale), int(w * scale), tile.shape[-1]), "float32")
+                total_weight = np.zeros((1, out.shape[1], out.shape[2], 1), "float32")
+            out[:, oy : oy + oh, ox : ox + ow] += tile * weight
+            total_weight[:, oy : oy + oh, ox : ox + ow] += weight
+
+            if stats is not None:
+                _, after = _memory_info()
+                peak = None
+                if before is not None and after is not None:
+                    peak = after["peak"] - before["current"]
+                stats.append(
+                    {"box": (y0, x0, th, tw), "seconds": elapsed, "peak_bytes": peak}
+                )
+    return out / total_weight
+
+
+def decode_tiled(decoder, latent, tile_size=32, overlap=8, stats=None):
+    # tile_size and overlap are in latent pixels (1/8 of the image size)
+    return apply_tiled(decoder, latent, tile_size, overlap, 8, stats)
+
+
+def encode_tiled(encoder, image, tile_size=256, overlap=64, stats=None):
+    # tile_size and overlap are in image pixels and must be multiples of 8
+    assert tile_size % 8 == 0 and overlap % 8 == 0, "Tiles must align to the 8x latent grid"
+    return apply_tiled(encoder, image, tile_size, overlap, 1 / 8, stats)
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ArrayCache:
+    # Bounded LRU cache of numpy arrays with hit/miss counters and an optional
+    # on-disk tier of .npy files that survives restarts. Keys must be hashable
+    # and have a stable repr(). The disk tier is not tied to a set of weights,
+    # so use one cache_dir per model.
+
+    def __init__(self, max_size=256, cache_dir=None):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest + ".npy")
+
+    def _remember(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            if self.cache_dir is not None and os.path.exists(self._path(key)):
+                value = np.load(self._path(key))
+                self._remember(key, value)
+                self.hits += 1
+                self.disk_hits += 1
+                return value
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        value = np.asarray(value)
+        with self._lock:
+            if self.max_size > 0:
+                self._remember(key, value)
+            if self.cache_dir is not None:
+                # Write then rename so a concurrent reader never sees a partial file
+                path = self._path(key)
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    np.save(f, value)
+                os.replace(tmp_path, path)
+        return value
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, compute())
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.disk_hits = self.misses = 0
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+def content_hash(value):
+    # Digest of an image's content: the bytes of a file path or of encoded
+    # bytes, or the shape, dtype and data of an array, PIL image or tensor.
+    # Equal images under different names match, as do a file and its bytes.
+    digest = hashlib.sha1()
+    if isinstance(value, str):
+        with open(value, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        digest.update(value)
+    else:
+        array = np.ascontiguousarray(value)
+        digest.update(f"{array.shape}{array.dtype}".encode("utf-8"))
+        digest.update(array.data)
+    return digest.hexdigest()
@@ -1,9 +1,12 @@
 import gzip
+import heapq
 import html
 import os
+import pickle
 from functools import lru_cache
 
-#pip install ftfy
+import ftfy
+import numpy as np
 import regex as re
 
 import tensorflow as tf
@@ -75,81 +78,127 @@ def whitespace_clean(text):
     return text
 
 
+@lru_cache()
+def load_vocab(bpe_path):
+    """Returns (encoder, bpe_ranks) for a merges file.
+
+    Parsing the gzipped merges takes a while, so the result is pickled next to
+    it (when writable) and shared by all tokenizers in the process.
+    """
+    stat = os.stat(bpe_path)
+    pickle_path = bpe_path + ".pkl"
+    try:
+        with open(pickle_path, "rb") as f:
+            cached = pickle.load(f)
+        if cached["source"] == (stat.st_size, stat.st_mtime):
+            return cached["encoder"], cached["bpe_ranks"]
+    except (OSError, pickle.UnpicklingError, EOFError, KeyError):
+        pass
+
+    merges = gzip.open(bpe_path).read().decode("utf-8").split("\n")
+    merges = merges[1 : 49152 - 256 - 2 + 1]
+    merges = [tuple(merge.split()) for merge in merges]
+    vocab = list(bytes_to_unicode().values())
+    vocab = vocab + [v + "</w>" for v in vocab]
+    for merge in merges:
+        vocab.append("".join(merge))
+    vocab.extend(["<|startoftext|>", "<|endoftext|>"])
+    encoder = dict(zip(vocab, range(len(vocab))))
+    bpe_ranks = dict(zip(merges, range(len(merges))))
+
+    try:
+        tmp_path = f"{pickle_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(
+                {"source": (stat.st_size, stat.st_mtime), "encoder": encoder, "bpe_ranks": bpe_ranks},
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(tmp_path, pickle_path)
+    except OSError:
+        pass
+    return encoder, bpe_ranks
+
+
 class SimpleTokenizer(object):
-    def __init__(self, bpe_path: str = default_bpe()):
+    def __init__(self, bpe_path: str = default_bpe(), cache_size: int = 10000):
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
-        merges = gzip.open(bpe_path).read().decode("utf-8").split("\n")
-        merges = merges[1 : 49152 - 256 - 2 + 1]
-        merges = [tuple(merge.split()) for merge in merges]
-        vocab = list(bytes_to_unicode().values())
-        vocab = vocab + [v + "</w>" for v in vocab]
-        for merge in merges:
-            vocab.append("".join(merge))
-        vocab.extend(["<|startoftext|>", "<|endoftext|>"])
-        self.encoder = dict(zip(vocab, range(len(vocab))))
+        self.encoder, self.bpe_ranks = load_vocab(bpe_path)
         self.decoder = {v: k for k, v in self.encoder.items()}
-        self.bpe_ranks = dict(zip(merges, range(len(merges))))
-        self.cache = {
-            "<|startoftext|>": "<|startoftext|>",
-            "<|endoftext|>": "<|endoftext|>",
-        }
+        self.special_tokens = {"<|startoftext|>", "<|endoftext|>"}
+        # Bounded per-word caches of merge results and of token ids
+        self._merge_cached = lru_cache(maxsize=cache_size)(self._merge)
+        self._token_ids = lru_cache(maxsize=cache_size)(self._encode_token)
         self.pat = re.compile(
             r"""<\|startoftext\|>|<\|endoftext\|>|'s|'t|'re|'ve|'m|'ll|'d|[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+""",
             re.IGNORECASE,
         )
 
     def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-        word = tuple(token[:-1]) + (token[-1] + "</w>",)
-        pairs = get_pairs(word)
-
-        if not pairs:
-            return token + "</w>"
-
-        while True:
-            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(pair, float("inf")))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
-                    new_word.append(first + second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-        word = " ".join(word)
-        self.cache[token] = word
-        return word
+        if token in self.special_tokens:
+            return token
+        return self._merge_cached(token)
+
+    def _merge(self, token):
+        # Applies merges lowest rank first through a heap of adjacent pairs
+        # over a linked list of symbols, instead of rescanning every pair for
+        # each merge. A merge only creates pairs of higher rank, so this gives
+        # the same result as merging all occurrences of the best pair at a time.
+        symbols = list(token[:-1]) + [token[-1] + "</w>"]
+        if len(symbols) == 1:
+            return symbols[0]
+        next_ = list(range(1, len(symbols))) + [-1]
+        prev = list(range(-1, len(symbols) - 1))
+        ranks = self.bpe_ranks
+
+        heap = []
+        for i in range(len(symbols) - 1):
+            rank = ranks.get((symbols[i], symbols[i + 1]))
+            if rank is not None:
+                heap.append((rank, i, symbols[i], symbols[i + 1]))
+        heapq.heapify(heap)
+
+        while heap:
+            _, i, first, second = heapq.heappop(heap)
+            j = next_[i]
+            # Skip pairs invalidated by an earlier merge
+            if j == -1 or symbols[i] != first or symbols[j] != second:
+                continue
+            symbols[i] = first + second
+            symbols[j] = None
+            next_[i] = next_[j]
+            if next_[j] != -1:
+                prev[next_[j]] = i
+            for a, b in ((prev[i], i), (i, next_[i])):
+                if a != -1 and b != -1:
+                    rank = ranks.get((symbols[a], symbols[b]))
+                    if rank is not None:
+                        heapq.heappush(heap, (rank, a, symbols[a], symbols[b]))
+        return " ".join(s for s in symbols if s is not None)
+
+    def _encode_token(self, token):
+        token = "".join(self.byte_encoder[b] for b in token.encode("utf-8"))
+        return tuple(self.encoder[bpe_token] for bpe_token in self.bpe(token).split(" "))
 
     def encode(self, text):
         bpe_tokens = []
         text = whitespace_clean(basic_clean(text)).lower()
         for token in re.findall(self.pat, text):
-            token = "".join(self.byte_encoder[b] for b in token.encode("utf-8"))
-            bpe_tokens.extend(
-                self.encoder[bpe_token] for bpe_token in self.bpe(token).split(" ")
-            )
+            bpe_tokens.extend(self._token_ids(token))
         return [49406] + bpe_tokens + [49407]
 
+    def encode_batch(self, texts, max_length=77):
+        # int32 [len(texts), max_length] token ids, truncated (keeping the end
+        # token) and padded with the end token, as the text encoder expects
+        ids = np.full((len(texts), max_length), 49407, dtype=np.int32)
+        for row, text in zip(ids, texts):
+            tokens = self.encode(text)
+            if len(tokens) > max_length:
+                tokens = tokens[: max_length - 1] + [49407]
+            row[: len(tokens)] = tokens
+        return ids
+
     def decode(self, tokens):
         text = "".join([self.decoder[token] for token in tokens])
         text = (
@@ -1,7 +1,7 @@
 import tensorflow as tf
 from tensorflow import keras
 
-from .layers import PaddedConv2D, apply_seq, td_dot, GEGLU
+from .layers import PaddedConv2D, apply_seq, td_dot, GEGLU, chunked_attention, shape_list
 
 
 class ResBlock(keras.layers.Layer):
@@ -36,8 +36,10 @@ class ResBlock(keras.layers.Layer):
 
 
 class CrossAttention(keras.layers.Layer):
-    def __init__(self, n_heads, d_head):
+    def __init__(self, n_heads, d_head, attention_chunk_size=None):
         super().__init__()
+        # Chunk attention over queries and keys once the sequence is longer than this
+        self.attention_chunk_size = attention_chunk_size
         self.to_q = keras.layers.Dense(n_heads * d_head, use_bias=False)
         self.to_k = keras.layers.Dense(n_heads * d_head, use_bias=False)
         self.to_v = keras.layers.Dense(n_heads * d_head, use_bias=False)
@@ -55,8 +57,13 @@ class CrossAttention(keras.layers.Layer):
         q, k, v = self.to_q(x), self.to_k(context), self.to_v(context)
         assert len(x.shape) == 3
         q = tf.reshape(q, (-1, x.shape[1], self.num_heads, self.head_size))
-        k = tf.reshape(k, (-1, context.shape[1], self.num_heads, self.head_size))
-        v = tf.reshape(v, (-1, context.shape[1], self.num_heads, self.head_size))
+        # The context length may be dynamic: long prompts are several 77-token windows
+        context_len = shape_list(context)[1]
+        k = tf.reshape(k, (-1, context_len, self.num_heads, self.head_size))
+        v = tf.reshape(v, (-1, context_len, self.num_heads, self.head_size))
+
+        if self.attention_chunk_size is not None and x.shape[1] > self.attention_chunk_size:
+            return apply_seq(self.chunked_call(q, k, v, x.shape[1]), self.to_out)
 
         q = keras.layers.Permute((2, 1, 3))(q)  # (bs, num_heads, time, head_size)
         k = keras.layers.Permute((2, 3, 1))(k)  # (bs, num_heads, head_size, time)
@@ -71,15 +78,28 @@ class CrossAttention(keras.layers.Layer):
         h_ = tf.reshape(attention, (-1, x.shape[1], self.num_heads * self.head_size))
         return apply_seq(h_, self.to_out)
 
+    def chunked_call(self, q, k, v, time):
+        # Fold heads into the batch: (bs * num_heads, time, head_size)
+        def fold(a):
+            a = keras.layers.Permute((2, 1, 3))(a)
+            return tf.reshape(a, (-1, shape_list(a)[2], self.head_size))
+
+        attention = chunked_attention(
+            fold(q) * self.scale, fold(k), fold(v), self.attention_chunk_size
+        )
+        attention = tf.reshape(attention, (-1, self.num_heads, time, self.head_size))
+        attention = keras.layers.Permute((2, 1, 3))(attention)
+        return tf.reshape(attention, (-1, time, self.num_heads * self.head_size))
+
 
 class BasicTransformerBlock(keras.layers.Layer):
-    def __init__(self, dim, n_heads, d_head):
+    def __init__(self, dim, n_heads, d_head, attention_chunk_size=None):
         super().__init__()
         self.norm1 = keras.layers.LayerNormalization(epsilon=1e-5)
-        self.attn1 = CrossAttention(n_heads, d_head)
+        self.attn1 = CrossAttention(n_heads, d_head, attention_chunk_size)
 
         self.norm2 = keras.layers.LayerNormalization(epsilon=1e-5)
-        self.attn2 = CrossAttention(n_heads, d_head)
+        self.attn2 = CrossAttention(n_heads, d_head, attention_chunk_size)
 
         self.norm3 = keras.layers.LayerNormalization(epsilon=1e-5)
         self.geglu = GEGLU(dim * 4)
@@ -93,12 +113,14 @@ class BasicTransformerBlock(keras.layers.Layer):
 
 
 class SpatialTransformer(keras.layers.Layer):
-    def __init__(self, channels, n_heads, d_head):
+    def __init__(self, channels, n_heads, d_head, attention_chunk_size=None):
         super().__init__()
         self.norm = tf.keras.layers.GroupNormalization(epsilon=1e-5)
         assert channels == n_heads * d_head
         self.proj_in = PaddedConv2D(n_heads * d_head, 1)
-        self.transformer_blocks = [BasicTransformerBlock(channels, n_heads, d_head)]
+        self.transformer_blocks = [
+            BasicTransformerBlock(channels, n_heads, d_head, attention_chunk_size)
+        ]
         self.proj_out = PaddedConv2D(channels, 1)
 
     def call(self, inputs):
@@ -135,7 +157,7 @@ class Upsample(keras.layers.Layer):
 
 
 class UNetModel(keras.models.Model):
-    def __init__(self):
+    def __init__(self, attention_chunk_size=None):
         super().__init__()
         self.time_embed = [
             keras.layers.Dense(1280),
@@ -144,44 +166,44 @@ class UNetModel(keras.models.Model):
         ]
         self.input_blocks = [
             [PaddedConv2D(320, kernel_size=3, padding=1)],
-            [ResBlock(320, 320), SpatialTransformer(320, 8, 40)],
-            [ResBlock(320, 320), SpatialTransformer(320, 8, 40)],
+            [ResBlock(320, 320), SpatialTransformer(320, 8, 40, attention_chunk_size)],
+            [ResBlock(320, 320), SpatialTransformer(320, 8, 40, attention_chunk_size)],
             [Downsample(320)],
-            [ResBlock(320, 640), SpatialTransformer(640, 8, 80)],
-            [ResBlock(640, 640), SpatialTransformer(640, 8, 80)],
+            [ResBlock(320, 640), SpatialTransformer(640, 8, 80, attention_chunk_size)],
+            [ResBlock(640, 640), SpatialTransformer(640, 8, 80, attention_chunk_size)],
             [Downsample(640)],
-            [ResBlock(640, 1280), SpatialTransformer(1280, 8, 160)],
-            [ResBlock(1280, 1280), SpatialTransformer(1280, 8, 160)],
+            [ResBlock(640, 1280), SpatialTransformer(1280, 8, 160, attention_chunk_size)],
+            [ResBlock(1280, 1280), SpatialTransformer(1280, 8, 160, attention_chunk_size)],
             [Downsample(1280)],
             [ResBlock(1280, 1280)],
             [ResBlock(1280, 1280)],
         ]
         self.middle_block = [
             ResBlock(1280, 1280),
-            SpatialTransformer(1280, 8, 160),
+            SpatialTransformer(1280, 8, 160, attention_chunk_size),
             ResBlock(1280, 1280),
         ]
         self.output_blocks = [
             [ResBlock(2560, 1280)],
             [ResBlock(2560, 1280)],
             [ResBlock(2560, 1280), Upsample(1280)],
-            [ResBlock(2560, 1280), SpatialTransformer(1280, 8, 160)],
-            [ResBlock(2560, 1280), SpatialTransformer(1280, 8, 160)],
+            [ResBlock(2560, 1280), SpatialTransformer(1280, 8, 160, attention_chunk_size)],
+            [ResBlock(2560, 1280), SpatialTransformer(1280, 8, 160, attention_chunk_size)],
             [
                 ResBlock(1920, 1280),
-                SpatialTransformer(1280, 8, 160),
+                SpatialTransformer(1280, 8, 160, attention_chunk_size),
                 Upsample(1280),
             ],
-            [ResBlock(1920, 640), SpatialTransformer(640, 8, 80)],  # 6
-            [ResBlock(1280, 640), SpatialTransformer(640, 8, 80)],
+            [ResBlock(1920, 640), SpatialTransformer(640, 8, 80, attention_chunk_size)],  # 6
+            [ResBlock(1280, 640), SpatialTransformer(640, 8, 80, attention_chunk_size)],
             [
                 ResBlock(960, 640),
-                SpatialTransformer(640, 8, 80),
+                SpatialTransformer(640, 8, 80, attention_chunk_size),
                 Upsample(640),
             ],
-            [ResBlock(960, 320), SpatialTransformer(320, 8, 40)],
-            [ResBlock(640, 320), SpatialTransformer(320, 8, 40)],
-            [ResBlock(640, 320), SpatialTransformer(320, 8, 40)],
+            [ResBlock(960, 320), SpatialTransformer(320, 8, 40, attention_chunk_size)],
+            [ResBlock(640, 320), SpatialTransformer(320, 8, 40, attention_chunk_size)],
+            [ResBlock(640, 320), SpatialTransformer(320, 8, 40, attention_chunk_size)],
         ]
         self.out = [
             tf.keras.layers.GroupNormalization(epsilon=1e-5),
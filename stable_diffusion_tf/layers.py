@@ -42,8 +42,58 @@ def apply_seq(x, layers):
     return x
 
 
+def shape_list(x):
+    # Static dimensions where known, dynamic ones (e.g. the context length) otherwise
+    dynamic = tf.shape(x)
+    return [dim if dim is not None else dynamic[i] for i, dim in enumerate(x.shape)]
+
+
 def td_dot(a, b):
-    aa = tf.reshape(a, (-1, a.shape[2], a.shape[3]))
-    bb = tf.reshape(b, (-1, b.shape[2], b.shape[3]))
+    a_shape, b_shape = shape_list(a), shape_list(b)
+    aa = tf.reshape(a, (-1, a_shape[2], a_shape[3]))
+    bb = tf.reshape(b, (-1, b_shape[2], b_shape[3]))
     cc = keras.backend.batch_dot(aa, bb)
-    return tf.reshape(cc, (-1, a.shape[1], cc.shape[1], cc.shape[2]))
+    c_shape = shape_list(cc)
+    return tf.reshape(cc, (-1, a_shape[1], c_shape[1], c_shape[2]))
+
+
+def chunked_attention(q, k, v, chunk_size):
+    # softmax(q @ k^T) @ v without materialising the full score matrix: queries
+    # are processed chunk_size at a time, and within a query chunk the keys are
+    # too, with a running max / log-sum-exp softmax (as in flash attention).
+    # q: (n, tq, d) already scaled, k: (n, tk, d), v: (n, tk, dv)
+    tq, tk = q.shape[1], k.shape[1]
+    if tk is None:
+        key_chunks = [(0, None)]
+    else:
+        key_chunks = [(s, s + chunk_size) for s in range(0, tk, chunk_size)]
+
+    outputs = []
+    previous = []
+    for q_start in range(0, tq, chunk_size):
+        q_chunk = q[:, q_start : q_start + chunk_size]
+        running_max, denominator, numerator = None, None, None
+        for k_start, k_end in key_chunks:
+            k_chunk, v_chunk = k[:, k_start:k_end], v[:, k_start:k_end]
+            # In graph mode, chunks would otherwise run concurrently and the
+            # scores would all be alive at once
+            with tf.control_dependencies(previous):
+                score = tf.matmul(q_chunk, k_chunk, transpose_b=True)
+            chunk_max = tf.stop_gradient(tf.reduce_max(score, axis=-1, keepdims=True))
+            if running_max is None:
+                new_max = chunk_max
+            else:
+                new_max = tf.maximum(running_max, chunk_max)
+            weights = tf.exp(score - new_max)
+            chunk_sum = tf.reduce_sum(weights, axis=-1, keepdims=True)
+            chunk_out = tf.matmul(weights, v_chunk)
+            if running_max is None:
+                denominator, numerator = chunk_sum, chunk_out
+            else:
+                correction = tf.exp(running_max - new_max)
+                denominator = denominator * correction + chunk_sum
+                numerator = numerator * correction + chunk_out
+            running_max = new_max
+            previous = [numerator]
+        outputs.append(numerator / denominator)
+    return tf.concat(outputs, axis=1) if len(outputs) > 1 else outputs[0]
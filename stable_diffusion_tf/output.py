@@ -0,0 +1,176 @@
+import io
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+
+import numpy as np
+from PIL import Image, PngImagePlugin
+
+FORMATS = ("PNG", "JPEG", "WEBP")
+EXTENSIONS = {".png": "PNG", ".jpg": "JPEG", ".jpeg": "JPEG", ".webp": "WEBP"}
+
+# EXIF ImageDescription, holds the metadata of JPEG and WebP files as JSON
+_EXIF_DESCRIPTION = 0x010E
+
+
+def format_from_path(path, default="PNG"):
+    return EXTENSIONS.get(os.path.splitext(path)[1].lower(), default)
+
+
+def encode_image(image, format="PNG", metadata=None, quality=90):
+    # Encoded file bytes of a uint8 (h, w, 3) image. metadata (e.g. prompt,
+    # seed, steps) goes into PNG text chunks, or the EXIF description of JPEG
+    # and WebP files as JSON.
+    format = format.upper()
+    if format not in FORMATS:
+        raise ValueError(f"Unknown format {format!r}, expected one of {FORMATS}")
+    image = Image.fromarray(np.asarray(image, dtype=np.uint8))
+    options = {}
+    if format == "PNG":
+        if metadata:
+            info = PngImagePlugin.PngInfo()
+            for key, value in metadata.items():
+                info.add_text(str(key), str(value))
+            options["pnginfo"] = info
+    else:
+        options["quality"] = quality
+        if metadata:
+            exif = Image.Exif()
+            exif[_EXIF_DESCRIPTION] = json.dumps(metadata, default=str)
+            options["exif"] = exif.tobytes()
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **options)
+    return buffer.getvalue()
+
+
+def save_image(image, path, format=None, metadata=None, quality=90):
+    # Writes image to path, in the format of its extension unless given.
+    # Returns path.
+    data = encode_image(image, format or format_from_path(path), metadata, quality)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+class ImageWriter:
+    # Output stage: encodes (and optionally saves) generated images in a
+    # thread or process pool, so the caller can go on with the next batch.
+    # Each submit returns a concurrent.futures.Future of the file bytes, or of
+    # the path when one is given. Pillow releases the GIL while compressing,
+    # so threads usually suffice; processes=True avoids the GIL entirely at
+    # the cost of pickling each image to a worker; its workers are spawned,
+    # so the main script needs an `if __name__ == "__main__":` guard.
+
+    def __init__(self, max_workers=None, processes=False, format="PNG", quality=90):
+        self.format = format
+        self.quality = quality
+        if processes:
+            # spawn: forking a process that runs TensorFlow is not safe
+            self._pool = ProcessPoolExecutor(
+                max_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        else:
+            self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix="ImageWriter")
+        self._lock = threading.Lock()
+        # Results of submitted futures that are not written yet
+        self._chained = set()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self, wait=True):
+        # With wait, images still to come from submitted futures are written
+        # first; otherwise their results fail with a RuntimeError
+        if wait:
+            with self._lock:
+                chained = list(self._chained)
+            wait_futures(chained)
+        self._pool.shutdown(wait=wait)
+
+    def pending(self):
+        with self._lock:
+            return self.submitted - self.completed - self.failed
+
+    def submit(self, image, path=None, format=None, metadata=None):
+        # image: a uint8 (h, w, 3) array, or a Future of one such as a server
+        # returns, which is encoded once it is done without waiting for it here
+        with self._lock:
+            self.submitted += 1
+        if isinstance(image, Future):
+            result = Future()
+            with self._lock:
+                self._chained.add(result)
+            result.add_done_callback(self._unchain)
+            image.add_done_callback(
+                lambda done: self._chain(done, result, path, format, metadata)
+            )
+            return result
+        return self._encode(image, path, format, metadata)
+
+    def submit_batch(self, images, paths=None, format=None, metadata=None):
+        # One future per image of a batch (e.g. from generate_batch); paths and
+        # metadata are lists with one entry per image, or None
+        paths = paths or [None] * len(images)
+        metadata = metadata or [None] * len(images)
+        return [
+            self.submit(image, path, format, meta)
+            for image, path, meta in zip(images, paths, metadata)
+        ]
+
+    def _encode(self, image, path, format, metadata):
+        if path is None:
+            future = self._pool.submit(
+                encode_image, image, format or self.format, metadata, self.quality
+            )
+        else:
+            future = self._pool.submit(save_image, image, path, format, metadata, self.quality)
+        future.add_done_callback(self._count)
+        return future
+
+    def _chain(self, done, result, path, format, metadata):
+        if done.cancelled() or done.exception() is not None:
+            with self._lock:
+                self.failed += 1
+            if done.cancelled():
+                # Notify as well, so close() waiting on result wakes up
+                result.cancel()
+                result.set_running_or_notify_cancel()
+            else:
+                result.set_exception(done.exception())
+            return
+        try:
+            encoded = self._encode(done.result(), path, format, metadata)
+        except RuntimeError as e:
+            # The pool was shut down by close(wait=False) before the image came
+            with self._lock:
+                self.failed += 1
+            result.set_exception(e)
+            return
+        encoded.add_done_callback(lambda e: _copy_future(e, result))
+
+    def _unchain(self, result):
+        with self._lock:
+            self._chained.discard(result)
+
+    def _count(self, future):
+        with self._lock:
+            if future.exception() is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+
+def _copy_future(source, target):
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
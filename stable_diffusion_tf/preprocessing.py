@@ -0,0 +1,68 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+# Source images and masks can be file paths, encoded file bytes (e.g. an
+# upload), PIL images, numpy arrays or tf tensors of (h, w), (h, w, 3) or
+# (h, w, 4) pixels in [0, 255]. Arrays and tensors already at the target size
+# are used as they are, without a copy.
+
+BYTES_TYPES = (bytes, bytearray, memoryview)
+
+
+def decode_image(image):
+    # PIL image for paths and encoded bytes, anything else is returned as is
+    if isinstance(image, str):
+        return Image.open(image)
+    if isinstance(image, BYTES_TYPES):
+        return Image.open(io.BytesIO(image))
+    return image
+
+
+def resized_pixels(image, height, width):
+    # (height, width, 3) array of pixels in [0, 255], uint8 or float
+    image = decode_image(image)
+    if isinstance(image, Image.Image):
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        if image.size != (width, height):
+            image = image.resize((width, height))
+        return np.asarray(image)
+
+    if isinstance(image, tf.Tensor):
+        image = image.numpy()
+    image = np.asarray(image)
+    if image.ndim == 2:
+        image = image[..., None]
+    image = image[..., :3]
+    if image.shape[:2] != (height, width):
+        # Resize and convert to float in one op instead of a PIL round trip
+        image = tf.image.resize(image, (height, width), method="bicubic", antialias=True)
+        image = np.clip(image.numpy(), 0, 255)
+    if image.shape[-1] == 1:
+        image = np.broadcast_to(image, (height, width, 3))
+    return image
+
+
+def image_array(image, height, width):
+    # float32 (1, height, width, 3) in [0, 255], as decode_latent blends with
+    return np.asarray(resized_pixels(image, height, width), dtype=np.float32)[None]
+
+
+def image_tensor(image, height, width, dtype=tf.float32):
+    # (1, height, width, 3) encoder input in [-1, 1]
+    pixels = tf.cast(resized_pixels(image, height, width)[None], tf.float32)
+    return tf.cast(pixels * (2 / 255) - 1, dtype)
+
+
+def image_arrays(images, height, width, max_workers=None):
+    # float32 (len(images), height, width, 3) in [0, 255]. PIL decodes and
+    # resizes without holding the GIL, so several images load in parallel.
+    if len(images) == 1:
+        return image_array(images[0], height, width)
+    with ThreadPoolExecutor(max_workers) as pool:
+        pixels = list(pool.map(lambda image: resized_pixels(image, height, width), images))
+    return np.stack(pixels).astype(np.float32, copy=False)
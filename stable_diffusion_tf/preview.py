@@ -0,0 +1,24 @@
+import numpy as np
+
+# Linear map from the 4 latent channels to RGB in about [-1, 1], a least squares
+# fit of the SD 1.x decoder output. Good enough to watch an image form, at the
+# cost of one small matmul instead of a VAE decode.
+LATENT_RGB_FACTORS = np.array(
+    [
+        [0.298, 0.207, 0.208],
+        [0.187, 0.286, 0.173],
+        [-0.158, 0.189, 0.264],
+        [-0.184, -0.271, -0.473],
+    ],
+    dtype=np.float32,
+)
+
+
+def approximate_decode(latent, upscale=8):
+    # uint8 (batch, h, w, 3) preview of a (batch, h / 8, w / 8, 4) latent,
+    # nearest-neighbour upscaled to the image size by default
+    rgb = np.asarray(latent, dtype=np.float32) @ LATENT_RGB_FACTORS
+    rgb = np.clip((rgb + 1) / 2 * 255, 0, 255).astype("uint8")
+    if upscale > 1:
+        rgb = rgb.repeat(upscale, axis=1).repeat(upscale, axis=2)
+    return rgb
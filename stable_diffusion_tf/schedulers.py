@@ -0,0 +1,295 @@
+import math
+from functools import lru_cache
+
+import numpy as np
+import tensorflow as tf
+
+from .constants import _ALPHAS_CUMPROD
+
+# All schedulers work on latents in the DDPM parametrisation used by the rest of
+# the package (x_t = sqrt(a_t) * x_0 + sqrt(1 - a_t) * noise), so starting
+# latents, add_noise and the UNet input are the same whichever one is used.
+
+
+def get_timesteps(num_steps):
+    # Return evenly spaced values within a given interval
+    return np.arange(1, 1000, 1000 // num_steps)
+
+
+@lru_cache()
+def get_alphas(timesteps):
+    # DDIM alphas for a tuple of ascending timesteps, and the ones each step lands on
+    alphas = [_ALPHAS_CUMPROD[t] for t in timesteps]    # _ALPHAS_CUMPROD[0] = .99915, _ALPHAS_CUMPROD[999] = .00466
+    alphas_prev = [1.0] + alphas[:-1]
+    return alphas, alphas_prev
+
+
+@lru_cache()
+def _timestep_frequencies(dim, max_period):
+    half = dim // 2
+    return np.exp(-math.log(max_period) * np.arange(0, half, dtype="float32") / half)
+
+
+def timestep_embedding(timesteps, dim=320, max_period=10000):
+    # Sinusoidal embeddings, one row of size dim per timestep
+    args = np.asarray(timesteps).reshape(-1, 1) * _timestep_frequencies(dim, max_period)
+    return np.concatenate([np.cos(args), np.sin(args)], axis=-1)
+
+
+def per_sample(value, dtype="float32"):
+    # Scalars stay Python floats, sequences (one value per sample) become
+    # (batch, 1, 1, 1) arrays that broadcast over latents
+    if np.ndim(value) == 0:
+        return float(value)
+    return np.asarray(value, dtype=dtype).reshape(-1, 1, 1, 1)
+
+
+def random_seed(batch_size=1):
+    # Base seed for a batch of samples that were not given one, leaving room
+    # for seed + i
+    return int(np.random.randint(0, 2**31 - batch_size))
+
+
+def seed_noise(seeds, shape, dtype=tf.float32, stream=0):
+    # Standard normal noise of (len(seeds),) + shape, sample i drawn statelessly
+    # from seeds[i] alone, independent of the other samples and the global seed.
+    # stream tells draws of one seed apart: 0 for the starting noise, step
+    # index + 1 for the noise stochastic schedulers add at that step.
+    return tf.concat(
+        [
+            tf.random.stateless_normal((1,) + tuple(shape), seed=[seed, stream], dtype=dtype)
+            for seed in seeds
+        ],
+        axis=0,
+    )
+
+
+class DiffusionSchedule:
+    # Device-resident tensors for one sampling schedule, so the loop only indexes
+    # into them. Build through get_schedule, which memoizes instances.
+
+    def __init__(self, num_steps, strength=None, dtype=tf.float32):
+        timesteps = get_timesteps(num_steps)
+        if strength is not None:
+            # img2img: only run the lower part of the schedule
+            idx_time = min(len(timesteps) - 1, int(len(timesteps) * strength))
+            timesteps = timesteps[:idx_time]
+        self.num_steps = num_steps
+        self.strength = strength
+        self.timesteps = timesteps
+        self.alphas, self.alphas_prev = get_alphas(tuple(timesteps))
+
+        self.t_embs = tf.constant(timestep_embedding(timesteps), dtype=dtype)
+        self.alphas_tensor = tf.constant(self.alphas, dtype=tf.float32)
+        self.alphas_prev_tensor = tf.constant(self.alphas_prev, dtype=tf.float32)
+
+    def __len__(self):
+        return len(self.timesteps)
+
+
+@lru_cache(maxsize=64)
+def get_schedule(num_steps, strength=None, dtype=tf.float32):
+    return DiffusionSchedule(num_steps, strength, dtype)
+
+
+class Scheduler:
+    # Whether step adds fresh noise
+    stochastic = False
+
+    def __init__(self, alphas_cumprod=_ALPHAS_CUMPROD):
+        self.alphas_cumprod = alphas_cumprod
+        self.timesteps = None
+        self._index = {}
+
+    def set_timesteps(self, num_steps):
+        # Timesteps are ascending, sampling walks them from the end
+        self.timesteps = get_timesteps(num_steps)
+        self._index = {t: i for i, t in enumerate(self.timesteps)}
+        self.reset()
+        return self.timesteps
+
+    def reset(self):
+        # Drop any history kept between steps by multistep solvers
+        pass
+
+    def get_alphas(self, timestep):
+        # Cumulative alpha at this timestep and at the one the step lands on.
+        # A sequence of timesteps, one per sample, gives per_sample arrays.
+        if np.ndim(timestep) > 0:
+            pairs = [self.get_alphas(t) for t in np.ravel(timestep)]
+            return per_sample([a for a, _ in pairs]), per_sample([p for _, p in pairs])
+        index = self._index[int(timestep)]
+        a_t = self.alphas_cumprod[self.timesteps[index]]
+        a_prev = self.alphas_cumprod[self.timesteps[index - 1]] if index > 0 else 1.0
+        return a_t, a_prev
+
+    def add_noise(self, latent, noise, timestep):
+        # _ALPHAS_CUMPROD[0] = .99915, _ALPHAS_CUMPROD[999] = .00466
+        a_t = per_sample(np.take(self.alphas_cumprod, np.asarray(timestep, dtype=int)))
+        return a_t ** 0.5 * latent + (1 - a_t) ** 0.5 * noise
+
+    def step(self, e_t, timestep, latent, noise=None):
+        # Returns (latent at the previous timestep, predicted x_0). Schedulers
+        # without history between steps also take one timestep per sample.
+        # noise: standard normal noise shaped like latent for stochastic
+        # schedulers, e.g. from seed_noise; None draws it from the global RNG.
+        raise NotImplementedError
+
+    def check_scalar(self, timestep):
+        if np.ndim(timestep) > 0:
+            raise ValueError(
+                f"{type(self).__name__} keeps one history for the whole batch and "
+                "needs a single timestep"
+            )
+
+
+def ddim_step(latent, e_t, a_t, a_prev, eta=0.0, noise=None):
+    # DDIM update for scalar or per_sample alphas, returns (x_prev, pred_x0)
+    pred_x0 = (latent - (1 - a_t) ** 0.5 * e_t) / a_t ** 0.5
+
+    sigma_t = eta * ((1 - a_prev) / (1 - a_t) * (1 - a_t / a_prev)) ** 0.5
+    dir_xt = (1.0 - a_prev - sigma_t**2) ** 0.5 * e_t # Direction pointing to x_t
+    x_prev = a_prev ** 0.5 * pred_x0 + dir_xt
+    if np.any(sigma_t > 0):
+        if noise is None:
+            noise = tf.random.normal(tf.shape(latent), dtype=latent.dtype)
+        x_prev = x_prev + sigma_t * noise
+    return x_prev, pred_x0
+
+
+class DDIMScheduler(Scheduler):
+    def __init__(self, eta=0.0, alphas_cumprod=_ALPHAS_CUMPROD):
+        super().__init__(alphas_cumprod)
+        self.eta = eta
+
+    @property
+    def stochastic(self):
+        return self.eta > 0
+
+    def step(self, e_t, timestep, latent, noise=None):
+        a_t, a_prev = self.get_alphas(timestep)
+        return ddim_step(latent, e_t, a_t, a_prev, self.eta, noise)
+
+
+class EulerScheduler(Scheduler):
+    # Euler steps on the probability-flow ODE in sigma space, where
+    # x = x_t / sqrt(a_t) and sigma = sqrt((1 - a_t) / a_t)
+
+    def get_sigmas(self, timestep):
+        a_t, a_prev = self.get_alphas(timestep)
+        sigma = ((1 - a_t) / a_t) ** 0.5
+        sigma_next = ((1 - a_prev) / a_prev) ** 0.5
+        return a_t, a_prev, sigma, sigma_next
+
+    def step(self, e_t, timestep, latent, noise=None):
+        a_t, a_prev, sigma, sigma_next = self.get_sigmas(timestep)
+        x = latent / a_t ** 0.5
+        pred_x0 = x - sigma * e_t
+        x = x + (sigma_next - sigma) * e_t
+        return x * a_prev ** 0.5, pred_x0
+
+
+class EulerAncestralScheduler(EulerScheduler):
+    stochastic = True
+
+    def step(self, e_t, timestep, latent, noise=None):
+        a_t, a_prev, sigma, sigma_next = self.get_sigmas(timestep)
+        x = latent / a_t ** 0.5
+        pred_x0 = x - sigma * e_t
+
+        # Split the step into a deterministic part down to sigma_down and fresh
+        # noise of scale sigma_up
+        sigma_up = per_sample(
+            np.minimum(
+                sigma_next,
+                (sigma_next**2 * (sigma**2 - sigma_next**2) / sigma**2) ** 0.5,
+            )
+        )
+        sigma_down = (sigma_next**2 - sigma_up**2) ** 0.5
+        x = x + (sigma_down - sigma) * e_t
+        if np.any(sigma_up > 0):
+            if noise is None:
+                noise = tf.random.normal(tf.shape(latent), dtype=latent.dtype)
+            x = x + sigma_up * noise
+        return x * a_prev ** 0.5, pred_x0
+
+
+class PNDMScheduler(Scheduler):
+    # Pseudo linear multistep (PLMS) variant of PNDM: the noise estimate is an
+    # Adams-Bashforth combination of up to four previous model outputs, with
+    # lower orders while the history fills up, then a DDIM transfer step.
+
+    def reset(self):
+        self.ets = []
+
+    def step(self, e_t, timestep, latent, noise=None):
+        self.check_scalar(timestep)
+        a_t, a_prev = self.get_alphas(timestep)
+        ets = self.ets
+        if len(ets) == 0:
+            e_prime = e_t
+        elif len(ets) == 1:
+            e_prime = (3 * e_t - ets[-1]) / 2
+        elif len(ets) == 2:
+            e_prime = (23 * e_t - 16 * ets[-1] + 5 * ets[-2]) / 12
+        else:
+            e_prime = (55 * e_t - 59 * ets[-1] + 37 * ets[-2] - 9 * ets[-3]) / 24
+        self.ets = (ets + [e_t])[-3:]
+
+        pred_x0 = (latent - math.sqrt(1 - a_t) * e_prime) / math.sqrt(a_t)
+        x_prev = math.sqrt(a_prev) * pred_x0 + math.sqrt(1.0 - a_prev) * e_prime
+        return x_prev, pred_x0
+
+
+class DPMSolverMultistepScheduler(Scheduler):
+    # DPM-Solver++ (2M): second order multistep solver on the data prediction,
+    # in log-SNR time lambda = log(alpha / sigma)
+
+    def reset(self):
+        self.prev_pred_x0 = None
+        self.prev_h = None
+
+    def step(self, e_t, timestep, latent, noise=None):
+        self.check_scalar(timestep)
+        a_t, a_prev = self.get_alphas(timestep)
+        alpha_t, sigma_t = math.sqrt(a_t), math.sqrt(1 - a_t)
+        pred_x0 = (latent - sigma_t * e_t) / alpha_t
+
+        if a_prev >= 1.0:
+            # Last step lands on sigma = 0, take the first order update
+            self.reset()
+            return pred_x0, pred_x0
+
+        alpha_prev, sigma_prev = math.sqrt(a_prev), math.sqrt(1 - a_prev)
+        h = math.log(alpha_prev / sigma_prev) - math.log(alpha_t / sigma_t)
+        denoised = pred_x0
+        if self.prev_pred_x0 is not None:
+            r = self.prev_h / h
+            denoised = (1 + 1 / (2 * r)) * pred_x0 - (1 / (2 * r)) * self.prev_pred_x0
+        x_prev = (sigma_prev / sigma_t) * latent - alpha_prev * math.expm1(-h) * denoised
+
+        self.prev_pred_x0 = pred_x0
+        self.prev_h = h
+        return x_prev, pred_x0
+
+
+SCHEDULERS = {
+    "ddim": DDIMScheduler,
+    "euler": EulerScheduler,
+    "euler_a": EulerAncestralScheduler,
+    "pndm": PNDMScheduler,
+    "dpmpp_2m": DPMSolverMultistepScheduler,
+}
+
+
+def get_scheduler(scheduler=None):
+    # Accepts a scheduler instance, a name from SCHEDULERS or None for DDIM
+    if scheduler is None:
+        return DDIMScheduler()
+    if isinstance(scheduler, str):
+        if scheduler not in SCHEDULERS:
+            raise ValueError(
+                f"Unknown scheduler {scheduler!r}, expected one of {sorted(SCHEDULERS)}"
+            )
+        return SCHEDULERS[scheduler]()
+    return scheduler
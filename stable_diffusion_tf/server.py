@@ -0,0 +1,700 @@
+import copy
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+import tensorflow as tf
+
+from .output import ImageWriter
+from .schedulers import DDIMScheduler, get_schedule, get_scheduler, random_seed, seed_noise
+from .stable_diffusion import GenerationRequest
+
+
+class _Pending:
+    def __init__(self, request, num_steps, img_height, img_width, scheduler, input_image=None, input_image_strength=0.5):
+        self.request = request
+        self.num_steps = num_steps
+        self.img_height = img_height
+        self.img_width = img_width
+        self.scheduler = scheduler
+        self.input_image = input_image
+        self.input_image_strength = input_image_strength
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+
+    @property
+    def key(self):
+        return (self.img_height, self.img_width, self.num_steps, self.scheduler)
+
+
+class _Server:
+    # Shared plumbing of the servers below: a worker thread started and
+    # stopped around the queue, submit() returning futures, and metrics.
+    #
+    # The worker owns the model: it switches its resolution and scheduler per
+    # batch, so do not use the model elsewhere while a server is running.
+
+    def __init__(self, model, max_batch_size=4, max_wait=0.05, metrics_window=1000):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._default_scheduler = model.scheduler
+        # The worker switches the model's resolution per batch, so the default
+        # size of requests is the one the model had when the server was created
+        self._default_size = (model.img_height, model.img_width)
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+        self.requests = 0
+        self.completed = 0
+        self.failed = 0
+        self.batches = 0
+        self._batch_sizes = deque(maxlen=metrics_window)
+        self._queue_waits = deque(maxlen=metrics_window)
+        self._latencies = deque(maxlen=metrics_window)
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return self
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, wait=True):
+        # Requests still queued are run before the worker exits
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def submit(
+        self,
+        prompt,
+        negative_prompt=None,
+        seed=None,
+        unconditional_guidance_scale=7.5,
+        num_steps=25,
+        img_height=None,
+        img_width=None,
+        scheduler=None,
+    ):
+        # Returns a Future resolving to a uint8 image. scheduler is a name from
+        # schedulers.SCHEDULERS, None uses the model's own.
+        return self._submit(
+            _Pending(
+                GenerationRequest(prompt, negative_prompt, seed, unconditional_guidance_scale),
+                num_steps,
+                img_height or self._default_size[0],
+                img_width or self._default_size[1],
+                scheduler,
+            )
+        )
+
+    def _submit(self, pending):
+        if pending.scheduler is not None:
+            get_scheduler(pending.scheduler)  # fail fast on unknown names
+        if pending.request.seed is None:
+            # One seed for the starting and step noise, whatever batch it joins
+            pending.request.seed = random_seed()
+        with self._cond:
+            if not self._running:
+                raise RuntimeError(f"{type(self).__name__} is not running, call start() first")
+            self._enqueue(pending)
+            self.requests += 1
+            self._cond.notify()
+        return pending.future
+
+    def _scheduler(self, name):
+        # A fresh scheduler, so per-batch state never leaks between batches
+        return copy.copy(self._default_scheduler) if name is None else get_scheduler(name)
+
+    def queue_depth(self):
+        with self._cond:
+            return self._queue_depth()
+
+    def metrics(self):
+        with self._cond:
+            queue_depth = self._queue_depth()
+            batch_sizes = list(self._batch_sizes)
+            queue_waits = list(self._queue_waits)
+            latencies = list(self._latencies)
+        return {
+            "queue_depth": queue_depth,
+            "requests": self.requests,
+            "completed": self.completed,
+            "failed": self.failed,
+            "batches": self.batches,
+            "mean_batch_size": float(np.mean(batch_sizes)) if batch_sizes else 0.0,
+            "mean_queue_wait": float(np.mean(queue_waits)) if queue_waits else 0.0,
+            "latency_p50": float(np.percentile(latencies, 50)) if latencies else 0.0,
+            "latency_p95": float(np.percentile(latencies, 95)) if latencies else 0.0,
+        }
+
+    def _finish(self, pending, result, started):
+        # started: when the request left the queue
+        with self._cond:
+            self.completed += 1
+            self._queue_waits.append(started - pending.enqueued)
+            self._latencies.append(time.perf_counter() - pending.enqueued)
+        pending.future.set_result(result)
+
+    def _fail(self, pending, error):
+        with self._cond:
+            self.failed += 1
+        pending.future.set_exception(error)
+
+
+class BatchingServer(_Server):
+    # Collects text-to-image requests from any number of threads and runs them
+    # through StableDiffusion.generate_batch on one worker thread. Requests are
+    # grouped by (img_height, img_width, num_steps, scheduler); a group is
+    # dispatched once it has max_batch_size requests or its oldest one has
+    # waited max_wait seconds. Results are delivered through futures, use
+    # asyncio.wrap_future to await them from a coroutine.
+
+    def __init__(self, model, max_batch_size=4, max_wait=0.05, metrics_window=1000):
+        super().__init__(model, max_batch_size, max_wait, metrics_window)
+        self._groups = {}
+
+    def _enqueue(self, pending):
+        self._groups.setdefault(pending.key, []).append(pending)
+
+    def _queue_depth(self):
+        return sum(len(group) for group in self._groups.values())
+
+    def _next_batch(self):
+        # Blocks until a group is due, returns (key, pending requests) or None
+        # once stopped with nothing left to run
+        with self._cond:
+            while True:
+                now = time.perf_counter()
+                due, wait = None, None
+                for key, group in self._groups.items():
+                    remaining = group[0].enqueued + self.max_wait - now
+                    if len(group) >= self.max_batch_size or remaining <= 0 or not self._running:
+                        due = key
+                        break
+                    wait = remaining if wait is None else min(wait, remaining)
+                if due is not None:
+                    group = self._groups[due]
+                    batch = group[: self.max_batch_size]
+                    del group[: self.max_batch_size]
+                    if not group:
+                        del self._groups[due]
+                    return due, batch
+                if not self._running:
+                    return None
+                self._cond.wait(wait)
+
+    def _run(self):
+        while True:
+            item = self._next_batch()
+            if item is None:
+                return
+            key, batch = item
+            # Skip requests cancelled while queued
+            batch = [p for p in batch if p.future.set_running_or_notify_cancel()]
+            if batch:
+                self._dispatch(key, batch)
+
+    def _dispatch(self, key, batch):
+        img_height, img_width, num_steps, scheduler = key
+        start = time.perf_counter()
+        try:
+            self.model.set_resolution(img_height, img_width)
+            self.model.scheduler = self._scheduler(scheduler)
+            images = self.model.generate_batch([p.request for p in batch], num_steps=num_steps)
+        except Exception as e:
+            for p in batch:
+                self._fail(p, e)
+            return
+
+        with self._cond:
+            self.batches += 1
+            self._batch_sizes.append(len(batch))
+        for p, image in zip(batch, images):
+            self._finish(p, image, start)
+
+
+class _Slot:
+    # One sample in the running batch of ContinuousBatchingServer
+    def __init__(self, pending, scheduler, schedule, latent, context, unconditional_context):
+        self.pending = pending
+        self.scheduler = scheduler
+        self.schedule = schedule
+        self.latent = latent
+        self.context = context
+        self.unconditional_context = unconditional_context
+        # Steps left, as (index into the schedule, timestep), latest first
+        self.steps = list(enumerate(schedule.timesteps))[::-1]
+        self.started = time.perf_counter()
+
+
+class ContinuousBatchingServer(_Server):
+    # Iteration-level batching: one running UNet batch of up to max_batch_size
+    # samples, each at its own point of its own schedule. Between steps,
+    # finished samples are decoded and leave, and queued requests join, so a
+    # short img2img job never waits for a long text-to-image one. Step counts
+    # and schedulers may differ within the batch; the resolution is shared,
+    # so a request for another size waits until the batch drains.
+
+    def __init__(self, model, max_batch_size=4, max_wait=0.05, metrics_window=1000):
+        super().__init__(model, max_batch_size, max_wait, metrics_window)
+        self._queue = deque()
+        self.steps = 0
+
+    def submit(
+        self,
+        prompt,
+        negative_prompt=None,
+        seed=None,
+        unconditional_guidance_scale=7.5,
+        num_steps=25,
+        img_height=None,
+        img_width=None,
+        scheduler=None,
+        input_image=None,
+        input_image_strength=0.5,
+    ):
+        # As BatchingServer.submit; input_image (a path, uploaded file bytes,
+        # PIL image, array or tensor, see preprocessing) makes
+        # it an img2img request running the lower input_image_strength of the schedule
+        return self._submit(
+            _Pending(
+                GenerationRequest(prompt, negative_prompt, seed, unconditional_guidance_scale),
+                num_steps,
+                img_height or self._default_size[0],
+                img_width or self._default_size[1],
+                scheduler,
+                input_image,
+                input_image_strength,
+            )
+        )
+
+    def _enqueue(self, pending):
+        self._queue.append(pending)
+
+    def _queue_depth(self):
+        return len(self._queue)
+
+    def _admit(self, slots):
+        # Pops the queued requests that can join the running batch, blocking
+        # while there is nothing to do. Returns None once stopped and drained.
+        with self._cond:
+            while True:
+                if not self._queue:
+                    if slots:
+                        return []
+                    if not self._running:
+                        return None
+                    self._cond.wait()
+                    continue
+                if slots or not self._running:
+                    break
+                # Idle: give a batch a moment to fill up before starting it
+                remaining = self._queue[0].enqueued + self.max_wait - time.perf_counter()
+                if len(self._queue) >= self.max_batch_size or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            size = (
+                (slots[0].pending.img_height, slots[0].pending.img_width)
+                if slots
+                else (self._queue[0].img_height, self._queue[0].img_width)
+            )
+            admitted = []
+            while self._queue and len(slots) + len(admitted) < self.max_batch_size:
+                # First come first served: a request for another size blocks
+                # the queue until the batch has drained
+                if (self._queue[0].img_height, self._queue[0].img_width) != size:
+                    break
+                admitted.append(self._queue.popleft())
+            return admitted
+
+    def _run(self):
+        slots = []
+        while True:
+            admitted = self._admit(slots)
+            if admitted is None:
+                return
+            admitted = [p for p in admitted if p.future.set_running_or_notify_cancel()]
+            source_latents = self._source_latents(admitted)
+            for pending in admitted:
+                try:
+                    slot = self._start_slot(pending, source_latents.get(id(pending)))
+                except Exception as e:
+                    self._fail(pending, e)
+                    continue
+                if slot is not None:
+                    slots.append(slot)
+            if not slots:
+                continue
+
+            try:
+                self._step(slots)
+            except Exception as e:
+                for slot in slots:
+                    self._fail(slot.pending, e)
+                slots = []
+                continue
+
+            finished = [slot for slot in slots if not slot.steps]
+            if finished:
+                slots = [slot for slot in slots if slot.steps]
+                self._decode(finished)
+
+    def _source_latents(self, admitted):
+        # Latents of the admitted img2img sources by id of their request, the
+        # uncached ones decoded in parallel and encoded as one batch. If one
+        # input is bad, each request encodes its own and only that one fails.
+        img2img = [p for p in admitted if p.input_image is not None]
+        if len(img2img) < 2:
+            return {}
+        self.model.set_resolution(img2img[0].img_height, img2img[0].img_width)
+        try:
+            latents = self.model.image_latents([p.input_image for p in img2img])
+        except Exception:
+            return {}
+        return {id(p): latent for p, latent in zip(img2img, latents)}
+
+    def _start_slot(self, pending, source_latent=None):
+        # Slot for a request joining the batch, or None if it finished already
+        model = self.model
+        model.set_resolution(pending.img_height, pending.img_width)
+        request = pending.request
+        context, unconditional_context = model.tokenize(request.prompt, request.negative_prompt)
+
+        scheduler = self._scheduler(pending.scheduler)
+        timesteps = scheduler.set_timesteps(pending.num_steps)
+        if pending.input_image is None:
+            schedule = get_schedule(pending.num_steps, dtype=model.dtype)
+            latent = model.request_noise(request.seed)
+        else:
+            strength = pending.input_image_strength
+            schedule = get_schedule(pending.num_steps, strength, model.dtype)
+            idx_time = min(len(timesteps) - 1, int(len(timesteps) * strength))
+            if source_latent is None:
+                source_latent = model.image_latent(pending.input_image)
+            latent = model.add_noise(
+                source_latent, timesteps[idx_time], model.latent_noise(request.seed)
+            )
+        slot = _Slot(pending, scheduler, schedule, latent, context, unconditional_context)
+        if not slot.steps:
+            # A strength below 1 / num_steps leaves no steps to run, as in
+            # generate_from_seed the noised source is the result
+            self._decode([slot])
+            return None
+        return slot
+
+    def _step(self, slots):
+        # One UNet pass over every slot, each at its own timestep
+        latent = tf.concat([slot.latent for slot in slots], axis=0)
+        timesteps = [slot.steps[0][1] for slot in slots]
+        t_emb = tf.stack([slot.schedule.t_embs[slot.steps[0][0]] for slot in slots])
+        # Long prompts give longer contexts, pad the others to share the batch
+        contexts = self.model.pad_contexts(
+            *[slot.context for slot in slots],
+            *[slot.unconditional_context for slot in slots],
+        )
+        e_t = self.model.get_model_output(
+            latent,
+            timesteps,
+            np.concatenate(contexts[: len(slots)]),
+            np.concatenate(contexts[len(slots) :]),
+            [slot.pending.request.unconditional_guidance_scale for slot in slots],
+            len(slots),
+            t_emb=t_emb,
+        )
+
+        # Deterministic DDIM slots step together with per-sample alphas, the
+        # others through their own scheduler
+        ddim = [
+            i
+            for i, slot in enumerate(slots)
+            if isinstance(slot.scheduler, DDIMScheduler) and slot.scheduler.eta == 0
+        ]
+        if ddim:
+            alphas = [slots[i].scheduler.get_alphas(timesteps[i]) for i in ddim]
+            x_prev, _ = self.model.get_x_prev_and_pred_x0(
+                tf.gather(latent, ddim),
+                tf.gather(e_t, ddim),
+                None,
+                [a_t for a_t, _ in alphas],
+                [a_prev for _, a_prev in alphas],
+            )
+            for j, i in enumerate(ddim):
+                slots[i].latent = x_prev[j : j + 1]
+        for i, slot in enumerate(slots):
+            if i not in ddim:
+                noise = None
+                if slot.scheduler.stochastic:
+                    # Keyed on the request's seed and step, as in sample_steps
+                    noise = seed_noise(
+                        [slot.pending.request.seed],
+                        slot.latent.shape[1:],
+                        slot.latent.dtype,
+                        stream=slot.steps[0][0] + 1,
+                    )
+                slot.latent, _ = slot.scheduler.step(
+                    e_t[i : i + 1], timesteps[i], slot.latent, noise
+                )
+            slot.steps.pop(0)
+
+        with self._cond:
+            self.steps += 1
+            self.batches += 1
+            self._batch_sizes.append(len(slots))
+
+    def _decode(self, finished):
+        try:
+            images = self.model.decode_latent(tf.concat([slot.latent for slot in finished], axis=0))
+        except Exception as e:
+            for slot in finished:
+                self._fail(slot.pending, e)
+            return
+        for slot, image in zip(finished, images):
+            self._finish(slot.pending, image, slot.started)
+
+
+# Marks the end of the work handed from one pipeline stage to the next
+_STOP = object()
+
+_STAGES = ("text", "unet", "decode", "encode")
+
+
+class _Job:
+    # One request travelling through the stages of PipelineServer
+    def __init__(self, pending, started):
+        self.pending = pending
+        self.started = started
+        self.inputs = None
+
+
+class PipelineServer(_Server):
+    # Runs requests through a pipeline of stage threads connected by bounded
+    # queues: tokenization, text encoding and starting noise, then the UNet
+    # loop, then the VAE decode, plus PNG/JPEG/WebP encoding in an ImageWriter
+    # pool when output_format is given. While the UNet samples one batch, the
+    # next requests are text encoded and the previous batch is decoded. TF
+    # releases the GIL inside ops, so the stages overlap as far as the device
+    # (and tf.config.threading's inter-op pool) allows.
+    #
+    # The UNet stage batches up to max_batch_size text-encoded requests with
+    # the same step count and scheduler that are waiting when it frees up.
+    # All requests run at the model's resolution, which must not change while
+    # the server runs. Futures resolve to uint8 images, or to encoded file
+    # bytes (with the prompt, seed and steps as metadata) with output_format.
+
+    def __init__(self, model, max_batch_size=4, max_wait=0.05, metrics_window=1000, queue_size=None, output_format=None, writer=None):
+        super().__init__(model, max_batch_size, max_wait, metrics_window)
+        self._queue = deque()
+        queue_size = queue_size or max_batch_size
+        self._unet_queue = queue.Queue(queue_size)
+        self._decode_queue = queue.Queue(queue_size)
+        self.output_format = output_format
+        self._writer = writer
+        self._owns_writer = False
+        self._stage_threads = []
+        self._stage_times = {name: deque(maxlen=metrics_window) for name in _STAGES}
+        self._stage_busy = dict.fromkeys(_STAGES, 0.0)
+        self._started = None
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return self
+        if self.output_format is not None and self._writer is None:
+            self._writer = ImageWriter(format=self.output_format)
+            self._owns_writer = True
+        self._started = time.perf_counter()
+        self._stage_threads = [
+            threading.Thread(target=self._run_unet, name="PipelineServer-unet", daemon=True),
+            threading.Thread(target=self._run_decode, name="PipelineServer-decode", daemon=True),
+        ]
+        for thread in self._stage_threads:
+            thread.start()
+        return super().start()
+
+    def stop(self, wait=True):
+        # Requests already submitted go through every stage before the threads exit
+        super().stop(wait)
+        if wait:
+            for thread in self._stage_threads:
+                thread.join()
+            if self._owns_writer:
+                self._writer.close()
+                self._writer = None
+                self._owns_writer = False
+
+    def _submit(self, pending):
+        if (pending.img_height, pending.img_width) != (self.model.img_height, self.model.img_width):
+            raise ValueError(
+                f"PipelineServer runs at the model's resolution "
+                f"{self.model.img_height}x{self.model.img_width}"
+            )
+        return super()._submit(pending)
+
+    def _enqueue(self, pending):
+        self._queue.append(pending)
+
+    def _queue_depth(self):
+        return len(self._queue)
+
+    def metrics(self):
+        # As the other servers, plus per stage: items processed, mean seconds
+        # per item, share of the server's lifetime it was busy, and the depth
+        # of the queue in front of it
+        metrics = super().metrics()
+        elapsed = time.perf_counter() - self._started if self._started else 0.0
+        depths = {
+            "text": metrics["queue_depth"],
+            "unet": self._unet_queue.qsize(),
+            "decode": self._decode_queue.qsize(),
+            "encode": self._writer.pending() if self._writer is not None else 0,
+        }
+        with self._cond:
+            metrics["stages"] = {
+                name: {
+                    "items": len(self._stage_times[name]),
+                    "mean_time": float(np.mean(self._stage_times[name])) if self._stage_times[name] else 0.0,
+                    "utilization": self._stage_busy[name] / elapsed if elapsed else 0.0,
+                    "queue_depth": depths[name],
+                }
+                for name in _STAGES
+            }
+        return metrics
+
+    def _timed(self, name, start, items=1):
+        elapsed = time.perf_counter() - start
+        with self._cond:
+            self._stage_busy[name] += elapsed
+            self._stage_times[name].extend([elapsed / items] * items)
+
+    def _next_request(self):
+        with self._cond:
+            while not self._queue:
+                if not self._running:
+                    return None
+                self._cond.wait()
+            return self._queue.popleft()
+
+    def _run(self):
+        # Text stage
+        while True:
+            pending = self._next_request()
+            if pending is None:
+                self._unet_queue.put(_STOP)
+                return
+            if not pending.future.set_running_or_notify_cancel():
+                continue
+            start = time.perf_counter()
+            job = _Job(pending, start)
+            try:
+                job.inputs = self.model.request_inputs(pending.request)
+            except Exception as e:
+                self._fail(pending, e)
+                continue
+            self._timed("text", start)
+            self._unet_queue.put(job)
+
+    def _run_unet(self):
+        held = None  # taken from the queue but not batchable with the last batch
+        while True:
+            job = held if held is not None else self._unet_queue.get()
+            held = None
+            if job is _STOP:
+                self._decode_queue.put(_STOP)
+                return
+            batch = [job]
+            while len(batch) < self.max_batch_size:
+                try:
+                    job = self._unet_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is _STOP or job.pending.key != batch[0].pending.key:
+                    held = job
+                    break
+                batch.append(job)
+            self._sample(batch)
+
+    def _sample(self, batch):
+        _, _, num_steps, scheduler = batch[0].pending.key
+        start = time.perf_counter()
+        try:
+            self.model.scheduler = self._scheduler(scheduler)
+            requests = [job.pending.request for job in batch]
+            context, unconditional_context, scales, latent = self.model.stack_inputs(
+                requests, [job.inputs for job in batch]
+            )
+            latent = self.model.sample_batch(
+                latent,
+                context,
+                unconditional_context,
+                scales,
+                num_steps,
+                seeds=[r.seed for r in requests],
+            )
+        except Exception as e:
+            for job in batch:
+                self._fail(job.pending, e)
+            return
+        self._timed("unet", start, len(batch))
+        with self._cond:
+            self.batches += 1
+            self._batch_sizes.append(len(batch))
+        self._decode_queue.put((batch, latent))
+
+    def _run_decode(self):
+        while True:
+            item = self._decode_queue.get()
+            if item is _STOP:
+                return
+            batch, latent = item
+            start = time.perf_counter()
+            try:
+                images = self.model.decode_latent(latent)
+            except Exception as e:
+                for job in batch:
+                    self._fail(job.pending, e)
+                continue
+            self._timed("decode", start, len(batch))
+            for job, image in zip(batch, images):
+                if self._writer is None:
+                    self._finish(job.pending, image, job.started)
+                else:
+                    self._encode(job, image)
+
+    def _encode(self, job, image):
+        request = job.pending.request
+        metadata = {
+            "prompt": request.prompt,
+            "negative_prompt": request.negative_prompt,
+            "seed": request.seed,
+            "steps": job.pending.num_steps,
+            "guidance_scale": request.unconditional_guidance_scale,
+        }
+        metadata = {key: value for key, value in metadata.items() if value is not None}
+        start = time.perf_counter()
+        future = self._writer.submit(image, format=self.output_format, metadata=metadata)
+
+        def done(future):
+            if future.exception() is not None:
+                self._fail(job.pending, future.exception())
+                return
+            self._timed("encode", start)
+            self._finish(job.pending, future.result(), job.started)
+
+        future.add_done_callback(done)
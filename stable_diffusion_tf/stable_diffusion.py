@@ -1,68 +1,271 @@
+import copy
 import numpy as np
 from tqdm import tqdm
-import math
+import threading
 
 import tensorflow as tf
 from tensorflow import keras
 
-from .autoencoder_kl import Decoder, Encoder
+from .autoencoder_kl import Decoder, Encoder, decode_tiled, encode_tiled
 from .diffusion_model import UNetModel
 from .clip_encoder import CLIPTextTransformer
 from .clip_tokenizer import SimpleTokenizer
-from .constants import _UNCONDITIONAL_TOKENS, _ALPHAS_CUMPROD
-from PIL import Image
+from .constants import _UNCONDITIONAL_TOKENS
+from .cache import ArrayCache, content_hash
+from .preprocessing import image_array, image_arrays
+from .preview import approximate_decode
+from .weights import load_weights, timed
+from .schedulers import (
+    DDIMScheduler,
+    get_alphas,
+    get_schedule,
+    ddim_step,
+    get_scheduler,
+    per_sample,
+    random_seed,
+    seed_noise,
+    timestep_embedding,
+)
 
 MAX_TEXT_LEN = 77
 
 # https://github.com/divamgupta/stable-diffusion-tensorflow
 
+class SamplerStep:
+    # State after one step of StableDiffusion.sample_steps
+    def __init__(self, index, timestep, latent, pred_x0):
+        self.index = index
+        self.timestep = timestep
+        self.latent = latent
+        self.pred_x0 = pred_x0
+
+
+class GenerationRequest:
+    # One text-to-image request for StableDiffusion.generate_batch
+    def __init__(self, prompt, negative_prompt=None, seed=None, unconditional_guidance_scale=7.5):
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.seed = seed
+        self.unconditional_guidance_scale = unconditional_guidance_scale
+
+
 class StableDiffusion:
-    def __init__(self, img_height=1000, img_width=1000, jit_compile=False, download_weights=True):
+    def __init__(self, img_height=1000, img_width=1000, jit_compile=False, download_weights=True, batch_cfg=True, compiled_sampler=False, scheduler=None, embedding_cache_size=256, embedding_cache_dir=None, vae_tile_size=None, vae_tile_overlap=8, attention_chunk_size=None, weights_dir=None, lazy=True, latent_cache_size=32, latent_cache_dir=None):
         self.img_height = img_height
         self.img_width = img_width
+        # Run the conditional and unconditional UNet passes as one batch
+        self.batch_cfg = batch_cfg
+        # Run the whole DDIM loop as one traced tf.function instead of eager steps
+        self.compiled_sampler = compiled_sampler
+        self.jit_compile = jit_compile
+        self._compiled_samplers = {}
+        # Sampler used by the diffusion loops: an instance or a name from schedulers.SCHEDULERS
+        self.scheduler = get_scheduler(scheduler)
         self.tokenizer = SimpleTokenizer()
+        # Text encoder outputs keyed by padded token ids, optionally backed by .npy files
+        self.embedding_cache = ArrayCache(embedding_cache_size, embedding_cache_dir)
+        self._unconditional_context = None
+        # Encoder outputs of source images keyed by content hash and resolution, see image_latent
+        self.latent_cache = ArrayCache(latent_cache_size, latent_cache_dir)
+        # Decode/encode in overlapping tiles of this many latent pixels to bound memory (None: whole image)
+        if vae_tile_size is not None and not 0 <= vae_tile_overlap < vae_tile_size:
+            raise ValueError(
+                f"vae_tile_overlap must be in [0, vae_tile_size), got {vae_tile_overlap} for vae_tile_size {vae_tile_size}"
+            )
+        self.vae_tile_size = vae_tile_size
+        self.vae_tile_overlap = vae_tile_overlap
+        self.last_decode_stats = []
+        self.last_encode_stats = []
+        self._tiled_decoder = None
+        self._tiled_encoder = None
 
-        text_encoder, diffusion_model, decoder, encoder = get_models(img_height, img_width, download_weights=download_weights)
-        self.text_encoder = text_encoder
-        self.diffusion_model = diffusion_model
-        self.decoder = decoder
-        self.encoder = encoder
-
-        if jit_compile:
-            self.text_encoder.compile(jit_compile=True)
-            self.diffusion_model.compile(jit_compile=True)
-            self.decoder.compile(jit_compile=True)
-            self.encoder.compile(jit_compile=True)
+        # attention_chunk_size: query/key chunk for memory-efficient attention in the UNet and VAE
+        # weights_dir: cache of converted weights for fast start, see weights.load_weights
+        # lazy: build and load each component on first use instead of all of them here,
+        # so text2img never pays for the encoder; see warmup
+        self.download_weights = download_weights
+        self.attention_chunk_size = attention_chunk_size
+        self.weights_dir = weights_dir
+        self.load_timings = {}
+        # Loaded Keras models by component name, each built at the resolution in use when loaded
+        self._components = {}
+        # Per-resolution Keras models sharing one set of weights, see set_resolution
+        self._resolution_models = {}
+        self._components_lock = threading.RLock()
 
         self.dtype = tf.float32
         if tf.keras.mixed_precision.global_policy().name == 'mixed_float16':
             self.dtype = tf.float16
-            
-    def encode(self, input_image):
-        return self.encoder(input_image)
+
+        if not lazy:
+            self.warmup()
+
+    @property
+    def text_encoder(self):
+        return self.get_component("text_encoder")
+
+    @property
+    def diffusion_model(self):
+        return self.get_component("diffusion_model")
+
+    @property
+    def decoder(self):
+        return self.get_component("decoder")
+
+    @property
+    def encoder(self):
+        return self.get_component("encoder")
+
+    def get_component(self, name):
+        # Keras model for a component at the current resolution, loading its
+        # weights the first time it is asked for
+        with self._components_lock:
+            if name not in self._components:
+                model = load_component(
+                    name,
+                    self.img_height,
+                    self.img_width,
+                    download_weights=self.download_weights,
+                    attention_chunk_size=self.attention_chunk_size,
+                    weights_dir=self.weights_dir,
+                    timings=self.load_timings,
+                )
+                if self.jit_compile:
+                    model.compile(jit_compile=True)
+                self._components[name] = model
+                if name != "text_encoder":
+                    key = (self.img_height, self.img_width)
+                    self._resolution_models.setdefault(key, {})[name] = model
+            if name == "text_encoder":
+                return self._components[name]
+
+            models = self._resolution_models.setdefault((self.img_height, self.img_width), {})
+            if name not in models:
+                # Wrap the already loaded layer, so no weights are rebuilt or reloaded
+                model = RESOLUTION_BUILDERS[name](
+                    self._components[name].layers[-1], self.img_height, self.img_width
+                )
+                if self.jit_compile:
+                    model.compile(jit_compile=True)
+                models[name] = model
+            return models[name]
+
+    def loaded_components(self):
+        return [name for name in COMPONENTS if name in self._components]
+
+    def warmup(self, components=None):
+        # Load the given components (default: all) ahead of the first request,
+        # returns their load timings
+        components = COMPONENTS if components is None else components
+        for name in components:
+            if name not in COMPONENTS:
+                raise ValueError(f"Unknown component {name!r}, expected one of {COMPONENTS}")
+            self.get_component(name)
+        return {name: self.load_timings.get(name, {}) for name in components}
+
+    def set_resolution(self, img_height, img_width):
+        # Switch the image size used by all methods. Models for a new size are
+        # created on first use around the already loaded layers.
+        self.img_height, self.img_width = img_height, img_width
+
+    def image_array(self, input_image):
+        # Source image (see preprocessing) at the current resolution, float32 RGB in [0, 255]
+        return image_array(input_image, self.img_height, self.img_width)
+
+    def image_latent(self, input_image):
+        # Encoded source image, cached by content and resolution so repeated
+        # img2img and inpainting on the same input skip decoding and the VAE
+        return self.image_latents([input_image])[0]
+
+    def image_latents(self, input_images):
+        # image_latent for several images: the missing ones are decoded in a
+        # thread pool and encoded as one batch
+        keys = [
+            (content_hash(image), self.img_height, self.img_width, self.vae_tile_size)
+            for image in input_images
+        ]
+        found = {}
+        for key in keys:
+            if key not in found:
+                found[key] = self.latent_cache.get(key)
+        # One index per missing key, so a file and its bytes are encoded once
+        missing = {key: keys.index(key) for key, latent in found.items() if latent is None}
+        if missing:
+            pixels = image_arrays(
+                [input_images[i] for i in missing.values()], self.img_height, self.img_width
+            )
+            encoded = np.asarray(self.encode(tf.cast(pixels * (2 / 255) - 1, self.dtype)))
+            for key, latent in zip(missing, encoded):
+                found[key] = self.latent_cache.put(key, latent[None])
+        # Cached arrays are shared, callers must not modify them in place
+        return [tf.convert_to_tensor(found[key], self.dtype) for key in keys]
+
+    def encode(self, input_image, tile_size=None):
+        # input_image is -1 to 1; tile_size is in latent pixels like vae_tile_size
+        tile_size = tile_size or self.vae_tile_size
+        if tile_size is None or (
+            input_image.shape[1] <= tile_size * 8 and input_image.shape[2] <= tile_size * 8
+        ):
+            return self.encoder(input_image)
+
+        if self._tiled_encoder is None:
+            # The inner Encoder layer accepts any spatial size, unlike the Keras model.
+            # Traced once per tile shape: its attention needs static spatial dims.
+            self._tiled_encoder = tf.function(self.encoder.layers[-1])
+        self.last_encode_stats = []
+        latent = encode_tiled(
+            self._tiled_encoder,
+            input_image,
+            tile_size * 8,
+            self.vae_tile_overlap * 8,
+            stats=self.last_encode_stats,
+        )
+        return tf.convert_to_tensor(latent)
     
-    def decode(self, encoded):
-        decoded = self.decoder.predict_on_batch(encoded)
+    def decode(self, encoded, tile_size=None):
+        decoded = self.decode_raw(encoded, tile_size)
         decoded = ((decoded + 1) / 2) * 255
         return np.clip(decoded, 0, 255).astype("uint8")[0,:,:,:]
     
     def text_encode(self, prompt):
         inputs = self.tokenizer.encode(prompt)
-        phrase = inputs + [49407] * (77 - len(inputs))
-        phrase = np.array(phrase)[None].astype("int32")
-        
-        # Encode prompt tokens (and their positions) into a "context vector"
-        pos_ids = np.array(list(range(77)))[None].astype("int32")
-        context = self.text_encoder.predict_on_batch([phrase, pos_ids])
+        context = self.context_from_inputs(inputs)
         return inputs, context
 
     def context_from_inputs(self, inputs):
-        phrase = inputs + [49407] * (77 - len(inputs))
-        phrase = np.array(phrase)[None].astype("int32")
-             
-        # Encode prompt tokens (and their positions) into a "context vector"
-        pos_ids = np.array(list(range(77)))[None].astype("int32")
-        return self.text_encoder.predict_on_batch([phrase, pos_ids])
+        # inputs: token ids from tokenizer.encode. Prompts longer than 77 tokens
+        # are encoded in windows of 75 as one batch and concatenated along the
+        # sequence axis, giving a context of 77 * windows tokens.
+        windows = token_windows(inputs)
+
+        def encode():
+            # Encode prompt tokens (and their positions) into a "context vector"
+            pos_ids = np.repeat(np.arange(MAX_TEXT_LEN, dtype="int32")[None], len(windows), axis=0)
+            out = self.text_encoder.predict_on_batch([np.array(windows, dtype="int32"), pos_ids])
+            return out.reshape(1, -1, out.shape[-1])
+
+        # Cached arrays are shared, callers must not modify them in place
+        key = tuple(token for window in windows for token in window)
+        return self.embedding_cache.get_or_compute(key, encode)
+
+    def unconditional_context(self):
+        # Context of the empty prompt, computed once per instance
+        if self._unconditional_context is None:
+            self._unconditional_context = self.context_from_inputs(_UNCONDITIONAL_TOKENS)
+        return self._unconditional_context
+
+    def pad_contexts(self, *contexts):
+        # Brings contexts of different prompt lengths to the longest one by
+        # appending empty-prompt windows, so they can share a batch
+        length = max(c.shape[1] for c in contexts)
+        padded = []
+        for context in contexts:
+            missing = (length - context.shape[1]) // MAX_TEXT_LEN
+            if missing:
+                padding = np.repeat(self.unconditional_context(), context.shape[0], axis=0)
+                context = np.concatenate([context] + [padding] * missing, axis=1)
+            padded.append(context)
+        return padded
     
     def tokenizer_decode(self, inputs):
         # tokens to text
@@ -81,44 +284,46 @@ class StableDiffusion:
         input_mask=None,
         input_image_strength=0.5,
         feedback = False,
-        use_auto_mask=False
+        use_auto_mask=False,
+        inpaint_mode="pixel",
+        callback=None,
+        preview="approx",
     ):
+        # input_image and input_mask: a path, encoded bytes, PIL image, array
+        # or tensor, see preprocessing. inpaint_mode: with input_image and input_mask, "pixel" runs the VAE
+        # round trips each step (and feeds the mix back with feedback=True),
+        # "latent" blends the noised source latent into the kept region instead
+        if inpaint_mode not in ("pixel", "latent"):
+            raise ValueError(f"Unknown inpaint_mode {inpaint_mode!r}, expected 'pixel' or 'latent'")
+        # callback(index, timestep, latent, preview) runs after every step; the
+        # preview, also used for the singles frames, is "approx" (linear
+        # latent-to-RGB) or "full" (VAE decode). The final image is always full.
+        if preview not in ("approx", "full"):
+            raise ValueError(f"Unknown preview {preview!r}, expected 'approx' or 'full'")
         singles = False
         if batch_size == 0:
             batch_size = 1
             singles = True
              
-        tf.random.set_seed(seed)
+        # Sample i uses seed + i for its starting and step noise, see latent_noise
+        if seed is None:
+            seed = random_seed(batch_size)
             
         # Tokenize prompt (i.e. starting context)
         inputs = self.tokenizer.encode(prompt)
-        assert len(inputs) < 77, "Prompt is too long (should be < 77 tokens)"
-        phrase = inputs + [49407] * (77 - len(inputs))
-        phrase = np.array(phrase)[None].astype("int32")
-        phrase = np.repeat(phrase, batch_size, axis=0)
-
-        # Encode prompt tokens (and their positions) into a "context vector"
-        pos_ids = np.array(list(range(77)))[None].astype("int32")
-        pos_ids = np.repeat(pos_ids, batch_size, axis=0)
-        context = self.text_encoder.predict_on_batch([phrase, pos_ids])
+        context = np.repeat(self.context_from_inputs(inputs), batch_size, axis=0)
         
-        input_image_tensor = None
+        source_latent = None
         input_image_array = None
-        if type(input_image) is str:
-            input_image = Image.open(input_image)
-            input_image = input_image.resize((self.img_width, self.img_height))
-            input_image_array = np.array(input_image, dtype=np.float32)[None,...,:3]
-            #print("generate_from_seed:input_image_array shape", input_image_array.shape)
-
-            input_image_tensor = tf.cast((input_image_array / 255.0) * 2 - 1, self.dtype)
-            #print("generate_from_seed:input_image_tensor shape", input_image_tensor.shape)
+        if input_image is not None:
+            source_latent = self.image_latent(input_image)
+            if input_mask is not None or use_auto_mask:
+                # Only the pixel blends in decode_latent need the image itself
+                input_image_array = self.image_array(input_image)
 
         input_mask_array = None
-        if type(input_mask) is str:
-            input_mask = Image.open(input_mask)
-            input_mask = input_mask.resize((self.img_width, self.img_height))
-            input_mask_array = np.array(input_mask, dtype=np.float32)[None,...,:3]
-            input_mask_array =  input_mask_array / 255.0
+        if input_mask is not None:
+            input_mask_array = self.image_array(input_mask) / 255.0
             #print("input_mask_array shape", input_mask_array.shape)
             
             #latent_mask = input_mask.resize((self.img_width//8, self.img_height//8))
@@ -129,35 +334,40 @@ class StableDiffusion:
             #print("latent_mask_tensor.shape", latent_mask_tensor.shape)    # latent_mask_tensor.shape (1, 64, 64, 3, 1)
             
 
-        # Tokenize negative prompt or use default padding tokens
-        unconditional_tokens = _UNCONDITIONAL_TOKENS
+        # Tokenize negative prompt or use the cached "unconditional context vector"
+        unconditional_context = self.unconditional_context()
         if negative_prompt is not None:
             inputs = self.tokenizer.encode(negative_prompt)
-            assert len(inputs) < 77, "Negative prompt is too long (should be < 77 tokens)"
-            unconditional_tokens = inputs + [49407] * (77 - len(inputs))
-
-        # Encode unconditional tokens (and their positions) into an
-        # "unconditional context vector"
-        unconditional_tokens = np.array(unconditional_tokens)[None].astype("int32")
-        unconditional_tokens = np.repeat(unconditional_tokens, batch_size, axis=0)
-        self.unconditional_tokens = tf.convert_to_tensor(unconditional_tokens)
-        unconditional_context = self.text_encoder.predict_on_batch(
-            [self.unconditional_tokens, pos_ids]
-        )
+            unconditional_context = self.context_from_inputs(inputs)
+        unconditional_context = np.repeat(unconditional_context, batch_size, axis=0)
+        context, unconditional_context = self.pad_contexts(context, unconditional_context)
         
-        # Return evenly spaced values within a given interval
-        timesteps = np.arange(1, 1000, 1000 // num_steps)
+        timesteps = self.scheduler.set_timesteps(num_steps)
         idx_time = min(len(timesteps)-1, int(len(timesteps)*input_image_strength*temperature))
         input_img_noise_t = timesteps[ idx_time ]
-        latent, alphas, alphas_prev = self.get_starting_parameters(
-            timesteps, batch_size, seed , input_image=input_image_tensor, input_img_noise_t=input_img_noise_t
+        latent_inpaint = (
+            inpaint_mode == "latent"
+            and source_latent is not None
+            and input_mask_array is not None
         )
+        if latent_inpaint:
+            # Shrink the mask once, the loop only blends tensors
+            latent_mask = self.latent_inpaint_mask(input_mask_array)
+            source_noise = self.latent_noise(seed, batch_size)
+            latent = self.add_noise(
+                tf.repeat(source_latent, batch_size, axis=0), input_img_noise_t, source_noise
+            )
+        else:
+            latent, alphas, alphas_prev = self.get_starting_parameters(
+                timesteps, batch_size, seed , input_latent=source_latent, input_img_noise_t=input_img_noise_t
+            )
         
         #print("latent shape", latent.shape)
 
-        if input_image is not None:
-            idx_time = min(len(timesteps)-1, int(len(timesteps)*input_image_strength))
-            timesteps = timesteps[: idx_time]
+        schedule = get_schedule(
+            num_steps, input_image_strength if input_image is not None else None, self.dtype
+        )
+        timesteps = schedule.timesteps
 
         #print(num_steps, idx_time, timesteps[idx_time])
         #print(timesteps)
@@ -165,34 +375,48 @@ class StableDiffusion:
         # Diffusion stage
         latent_orgin = None
         mix = None
-        latent_mix =  None
         out_list = []
-        progbar = tqdm(list(enumerate(timesteps))[::-1])
-        for index, timestep in progbar:
-            progbar.set_description(f"{index:3d} {timestep:3d}")
-            
-            if latent_mix is not None:
-                latent = latent_mix
-                
-            e_t = self.get_model_output(
+        steps = []
+        if (
+            self.can_compile_sampler()
+            and not singles
+            and input_mask is None
+            and callback is None
+        ):
+            # Nothing happens between steps, so the whole loop can run in graph mode
+            latent = self.sample_compiled(
                 latent,
-                timestep,
+                schedule,
+                context,
+                unconditional_context,
+                unconditional_guidance_scale,
+            )
+        else:
+            steps = self.sample_steps(
+                latent,
+                schedule,
                 context,
                 unconditional_context,
                 unconditional_guidance_scale,
                 batch_size,
+                seeds=range(seed, seed + batch_size),
             )
-            
-            a_t, a_prev = alphas[index], alphas_prev[index]
-            
-            latent, pred_x0 = self.get_x_prev_and_pred_x0(
-                latent, e_t, index, a_t, a_prev)#, temperature, seed)
+        for step in steps:
+            index, timestep, latent = step.index, step.timestep, step.latent
 
-            if input_mask is not None and input_image is not None:
+            if latent_inpaint:
+                latent = step.latent = self.blend_inpaint_latent(
+                    latent,
+                    source_latent,
+                    latent_mask,
+                    source_noise,
+                    timesteps[index - 1] if index > 0 else None,
+                )
+            elif input_mask is not None and input_image is not None:
                 # If mask is provided, noise at current timestep will be added to input image.
                 # The intermediate latent will be merged with input latent.
                 latent_orgin, alphas, alphas_prev = self.get_starting_parameters(
-                    timesteps, batch_size, seed , input_image=input_image_tensor, input_img_noise_t=timestep
+                    timesteps, batch_size, seed , input_latent=source_latent, input_img_noise_t=timestep
                 )#############'''
                 
                 #print("latent_orgin shape", latent_orgin.shape)
@@ -201,17 +425,22 @@ class StableDiffusion:
                 latent_decoded = self.decoder.predict_on_batch(latent)
                 latent_orgin_decoded = self.decoder.predict_on_batch(latent_orgin)
                 
-                # Feedback
+                # Feedback: the next step starts from the re-encoded mix
                 if feedback:
                     mix = latent_orgin_decoded * (1 - input_mask_array) + latent_decoded * (input_mask_array)
-                    latent_mix =  self.encoder(mix)
+                    step.latent = self.encode(mix)
             
+            if callback is not None:
+                callback(index, timestep, latent, self.preview_latent(latent, preview == "full"))
+
             if singles:
-                decoded = self.decode_latent(latent)#, input_image_array, input_mask_array)
+                decoded = self.preview_latent(latent, preview == "full")
                 out_list.append((decoded[0,:,:,:], "latent"))
                 
                 if input_mask is not None and input_image is not None:
-                    decoded = self.decode_latent(latent, input_image_array, input_mask_array)
+                    decoded = self.preview_latent(
+                        latent, preview == "full", input_image_array, input_mask_array
+                    )
                     out_list.append((decoded[0,:,:,:], "latent masked"))
                 
                 s='''if latent_orgin is not None:
@@ -224,9 +453,10 @@ class StableDiffusion:
                     out_list.append((mix, "mix"))################'''
                 
         if singles:
+            decoded = self.decode_latent(latent)
             out_list.append((decoded[0,:,:,:], ""))
         else:
-            if feedback:
+            if feedback and not latent_inpaint:
                 decoded = self.decode_latent(latent)
                 out_list.append((decoded[0,:,:,:], ""))
             else:
@@ -236,16 +466,25 @@ class StableDiffusion:
                        
         return out_list
     
+    def latent_inpaint_mask(self, input_mask_array):
+        # Pixel mask in [0, 1] (1 keeps the source, as in decode_latent) averaged
+        # over channels and down to one value per latent pixel
+        mask = tf.reduce_mean(tf.convert_to_tensor(input_mask_array, tf.float32), axis=-1, keepdims=True)
+        mask = tf.image.resize(mask, (self.img_height // 8, self.img_width // 8), method="area")
+        return tf.cast(mask, self.dtype)
+
+    def blend_inpaint_latent(self, latent, source_latent, latent_mask, noise, timestep):
+        # Put back the source, noised to the timestep latent is now at (None:
+        # the end of sampling), wherever the mask keeps it
+        source = source_latent
+        if timestep is not None:
+            source = self.scheduler.add_noise(source_latent, noise, timestep)
+        return source * latent_mask + latent * (1 - latent_mask)
+
     def get_latent(self, input_image=None):
-        input_image_tensor = None
-        input_image_array = None
         latent = None
-        if type(input_image) is str:
-            input_image = Image.open(input_image)
-            input_image = input_image.resize((self.img_width, self.img_height))
-            input_image_array = np.array(input_image, dtype=np.float32)[None,...,:3]
-            input_image_tensor = tf.cast((input_image_array / 255.0) * 2 - 1, self.dtype)
-            latent = self.encoder(input_image_tensor) 
+        if input_image is not None:
+            latent = self.image_latent(input_image)
             
         return latent
         
@@ -254,24 +493,11 @@ class StableDiffusion:
         seed,
         input_image=None
     ):
-        tf.random.set_seed(seed)
-        n_h = self.img_height // 8
-        n_w = self.img_width // 8
-        
-        input_image_tensor = None
-        input_image_array = None
         latent = None
-        if type(input_image) is str:
-            input_image = Image.open(input_image)
-            input_image = input_image.resize((self.img_width, self.img_height))
-            input_image_array = np.array(input_image, dtype=np.float32)[None,...,:3]
-            #print("get_noise_latent:input_image_array shape", input_image_array.shape)
-
-            input_image_tensor = tf.cast((input_image_array / 255.0) * 2 - 1, self.dtype)
-            #print("get_noise_latent:input_image_tensor shape", input_image_tensor.shape)
-            latent = self.encoder(input_image_tensor)    
+        if input_image is not None:
+            latent = self.image_latent(input_image)
             
-        return tf.random.normal((1, n_h, n_w, 4), seed=seed), latent
+        return self.latent_noise(seed), latent
     
     def get_noisy_img(
         self,
@@ -282,27 +508,17 @@ class StableDiffusion:
         input_image_strength=0.5,
     ):
         
-        tf.random.set_seed(seed)
-        
-        input_image_tensor = None
-        input_image_array = None
-        if type(input_image) is str:
-            input_image = Image.open(input_image)
-            input_image = input_image.resize((self.img_width, self.img_height))
-            input_image_array = np.array(input_image, dtype=np.float32)[None,...,:3]
-            #print("input_image_array shape", input_image_array.shape)
-
-            input_image_tensor = tf.cast((input_image_array / 255.0) * 2 - 1, self.dtype)
-            #print("input_image_tensor shape", input_image_tensor.shape)         
+        source_latent = None
+        if input_image is not None:
+            source_latent = self.image_latent(input_image)
         
-        # Return evenly spaced values within a given interval
-        timesteps = np.arange(1, 1000, 1000 // num_steps)
+        timesteps = self.scheduler.set_timesteps(num_steps)
         idx_time = min(len(timesteps)-1, int(len(timesteps)*input_image_strength*temperature))
         input_img_noise_t = timesteps[idx_time]
         #print(num_steps, idx_time, input_img_noise_t)
         #print(timesteps)
         latent, alphas, alphas_prev = self.get_starting_parameters(
-            timesteps, 1, seed , input_image=input_image_tensor, input_img_noise_t=input_img_noise_t
+            timesteps, 1, seed , input_latent=source_latent, input_img_noise_t=input_img_noise_t
         )
         
         return latent
@@ -318,8 +534,7 @@ class StableDiffusion:
         if latent is None:
             return noise_block
         
-        # Return evenly spaced values within a given interval
-        timesteps = np.arange(1, 1000, 1000 // num_steps)
+        timesteps = self.scheduler.set_timesteps(num_steps)
         idx_time = min(len(timesteps)-1, int(len(timesteps)*input_image_strength*temperature))
         input_img_noise_t = timesteps[ idx_time ]
         
@@ -339,7 +554,6 @@ class StableDiffusion:
         context, unconditional_context = self.tokenize(
             prompt, 
             negative_prompt,
-            num_steps
         )
         
         return self.diffuse(
@@ -375,8 +589,7 @@ class StableDiffusion:
         batch_size = 1
         seed = 1
         
-        # Return evenly spaced values within a given interval
-        timesteps = np.arange(1, 1000, 1000 // num_steps)
+        timesteps = self.scheduler.set_timesteps(num_steps)
         latent, alphas, alphas_prev = self.get_starting_parameters(
             timesteps, batch_size, seed , noise=noise_img_block
         )
@@ -384,7 +597,6 @@ class StableDiffusion:
         context, unconditional_context = self.tokenize(
             prompt, 
             negative_prompt,
-            num_steps
         )
         
         return self.diffuse(
@@ -420,8 +632,7 @@ class StableDiffusion:
         batch_size = 1
         seed = 1
         
-        # Return evenly spaced values within a given interval
-        timesteps = np.arange(1, 1000, 1000 // num_steps)
+        timesteps = self.scheduler.set_timesteps(num_steps)
         latent, alphas, alphas_prev = self.get_starting_parameters(
             timesteps, batch_size, seed , noise=noise_img_block
         )
@@ -436,6 +647,113 @@ class StableDiffusion:
             use_auto_mask
         ) 
         
+    def generate_batch(self, requests, num_steps=25, callback=None, preview="approx"):
+        # Text-to-image for several GenerationRequests (or dicts of their
+        # arguments) in one UNet batch, with per-request prompts, seeds and
+        # guidance scales. Returns one uint8 image per request, in order.
+        requests = [
+            r if isinstance(r, GenerationRequest) else GenerationRequest(**r)
+            for r in requests
+        ]
+        # Fix missing seeds now, the starting and the step noise use the same one
+        requests = [
+            r
+            if r.seed is not None
+            else GenerationRequest(
+                r.prompt, r.negative_prompt, random_seed(), r.unconditional_guidance_scale
+            )
+            for r in requests
+        ]
+        context, unconditional_context, scales, latent = self.batch_inputs(requests)
+        latent = self.sample_batch(
+            latent,
+            context,
+            unconditional_context,
+            scales,
+            num_steps,
+            callback,
+            preview,
+            seeds=[r.seed for r in requests],
+        )
+        return list(self.decode_latent(latent))
+
+    def sample_batch(
+        self,
+        latent,
+        context,
+        unconditional_context,
+        scales,
+        num_steps=25,
+        callback=None,
+        preview="approx",
+        seeds=None,
+    ):
+        # The text-to-image sampling loop of generate_batch on stacked inputs
+        # from batch_inputs, returns the final latent. seeds as in sample_steps.
+        schedule = get_schedule(num_steps, dtype=self.dtype)
+        if self.can_compile_sampler() and callback is None:
+            return self.sample_compiled(
+                latent, schedule, context, unconditional_context, scales
+            )
+        for step in self.sample_steps(
+            latent,
+            schedule,
+            context,
+            unconditional_context,
+            scales,
+            latent.shape[0],
+            seeds=seeds,
+        ):
+            latent = step.latent
+            if callback is not None:
+                callback(step.index, step.timestep, latent, self.preview_latent(latent, preview == "full"))
+        return latent
+
+    def batch_inputs(self, requests):
+        # Stacked contexts, guidance scales shaped (batch, 1, 1, 1) to broadcast
+        # over the noise predictions, and starting noise for GenerationRequests
+        return self.stack_inputs(requests, [self.request_inputs(r) for r in requests])
+
+    def request_inputs(self, request):
+        # (context, unconditional context, starting noise) of one GenerationRequest
+        context, unconditional_context = self.tokenize(request.prompt, request.negative_prompt)
+        return context, unconditional_context, self.request_noise(request.seed)
+
+    def stack_inputs(self, requests, inputs):
+        # batch_inputs from the request_inputs of each request
+        contexts, unconditional_contexts, latents = zip(*inputs)
+        scales = np.array(
+            [r.unconditional_guidance_scale for r in requests], dtype=np.float32
+        ).reshape(-1, 1, 1, 1)
+        padded = self.pad_contexts(*contexts, *unconditional_contexts)
+        return (
+            np.concatenate(padded[: len(requests)]),
+            np.concatenate(padded[len(requests) :]),
+            tf.cast(scales, self.dtype),
+            tf.concat(latents, axis=0),
+        )
+
+    def request_noise(self, seed):
+        # Starting latent of one sample, the same generate_from_seed draws for this seed
+        return self.latent_noise(seed)
+
+    def latent_noise(self, seed, batch_size=1):
+        # Starting noise for a batch whose samples use seed, seed + 1, ... (a
+        # random base seed if None). Each sample's noise comes from its own
+        # stateless draw, so a seed gives the same image alone or in any batch.
+        if seed is None:
+            seed = random_seed(batch_size)
+        return seed_noise(
+            range(seed, seed + batch_size),
+            (self.img_height // 8, self.img_width // 8, 4),
+            self.dtype,
+        )
+
+    def batch_context(self, context, batch_size):
+        if context.shape[0] == 1 and batch_size > 1:
+            return np.repeat(context, batch_size, axis=0)
+        return context
+
     def tokenize(
         self,
         prompt,
@@ -443,34 +761,102 @@ class StableDiffusion:
     ):            
         # Tokenize prompt (i.e. starting context)
         inputs = self.tokenizer.encode(prompt)
-        assert len(inputs) < 77, "Prompt is too long (should be < 77 tokens)"
-        phrase = inputs + [49407] * (77 - len(inputs))
-        phrase = np.array(phrase)[None].astype("int32")
-        #phrase = np.repeat(phrase, batch_size, axis=0)
-
-        # Encode prompt tokens (and their positions) into a "context vector"
-        pos_ids = np.array(list(range(77)))[None].astype("int32")
-        #pos_ids = np.repeat(pos_ids, batch_size, axis=0)
-        context = self.text_encoder.predict_on_batch([phrase, pos_ids])
+        context = self.context_from_inputs(inputs)
         
-        # Tokenize negative prompt or use default padding tokens
-        unconditional_tokens = _UNCONDITIONAL_TOKENS
+        # Tokenize negative prompt or use the cached "unconditional context vector"
+        unconditional_context = self.unconditional_context()
         if negative_prompt is not None:
             inputs = self.tokenizer.encode(negative_prompt)
-            assert len(inputs) < 77, "Negative prompt is too long (should be < 77 tokens)"
-            unconditional_tokens = inputs + [49407] * (77 - len(inputs))
-
-        # Encode unconditional tokens (and their positions) into an
-        # "unconditional context vector"
-        unconditional_tokens = np.array(unconditional_tokens)[None].astype("int32")
-        #unconditional_tokens = np.repeat(unconditional_tokens, batch_size, axis=0)
-        self.unconditional_tokens = tf.convert_to_tensor(unconditional_tokens)
-        unconditional_context = self.text_encoder.predict_on_batch(
-            [self.unconditional_tokens, pos_ids]
-        )
+            unconditional_context = self.context_from_inputs(inputs)
         
-        return context, unconditional_context
+        return tuple(self.pad_contexts(context, unconditional_context))
     
+    def sample_steps(
+        self,
+        latent,
+        schedule,
+        context,
+        unconditional_context,
+        unconditional_guidance_scale=7.5,
+        batch_size=None,
+        cancel=None,
+        progress=True,
+        seeds=None,
+    ):
+        # Eager sampling loop as an iterator of SamplerStep, latest timestep
+        # first; schedule comes from get_schedule. Stop early by leaving the
+        # loop, or from another thread through cancel (anything with is_set(),
+        # e.g. a threading.Event). Setting step.latent before resuming changes
+        # where the next step starts from. seeds: one per sample, keys the
+        # noise of stochastic schedulers (global RNG if None).
+        batch_size = batch_size or latent.shape[0]
+        # A copy per loop: multistep schedulers keep history between steps, which
+        # concurrent loops on one instance would otherwise reset and mix up
+        scheduler = copy.copy(self.scheduler)
+        scheduler.set_timesteps(schedule.num_steps)
+        steps = list(enumerate(schedule.timesteps))[::-1]
+        progbar = tqdm(steps) if progress else None
+        try:
+            for index, timestep in steps:
+                if cancel is not None and cancel.is_set():
+                    return
+                if progbar is not None:
+                    progbar.set_description(f"{index:3d} {timestep:3d}")
+
+                e_t = self.get_model_output(
+                    latent,
+                    timestep,
+                    context,
+                    unconditional_context,
+                    unconditional_guidance_scale,
+                    batch_size,
+                    t_emb=schedule.t_embs[index],
+                )
+                noise = None
+                if seeds is not None and scheduler.stochastic:
+                    noise = seed_noise(seeds, latent.shape[1:], latent.dtype, stream=index + 1)
+                latent, pred_x0 = scheduler.step(e_t, timestep, latent, noise)
+
+                step = SamplerStep(index, timestep, latent, pred_x0)
+                yield step
+                latent = step.latent
+                if progbar is not None:
+                    progbar.update()
+        finally:
+            if progbar is not None:
+                progbar.close()
+
+    def generate_steps(
+        self,
+        prompt,
+        negative_prompt=None,
+        batch_size=1,
+        num_steps=25,
+        unconditional_guidance_scale=7.5,
+        seed=None,
+        cancel=None,
+    ):
+        # Streaming text-to-image: yields a SamplerStep per step, decode the
+        # latent of the last one with decode_latent
+        if seed is None:
+            seed = random_seed(batch_size)
+        context, unconditional_context = self.tokenize(prompt, negative_prompt)
+        context = np.repeat(context, batch_size, axis=0)
+        unconditional_context = np.repeat(unconditional_context, batch_size, axis=0)
+
+        schedule = get_schedule(num_steps, dtype=self.dtype)
+        latent, _, _ = self.get_starting_parameters(schedule.timesteps, batch_size, seed)
+        yield from self.sample_steps(
+            latent,
+            schedule,
+            context,
+            unconditional_context,
+            unconditional_guidance_scale,
+            batch_size,
+            cancel=cancel,
+            seeds=range(seed, seed + batch_size),
+        )
+
     def diffuse(
         self,
         latent,
@@ -479,13 +865,18 @@ class StableDiffusion:
         num_steps=25,
         unconditional_guidance_scale=7.5,
         input_image_strength=1,
-        use_auto_mask=False
+        use_auto_mask=False,
+        callback=None,
+        preview="approx",
     ):
-        batch_size = 1
+        # callback and preview as in generate_from_seed. The batch size follows
+        # latent, contexts of batch 1 are shared by all samples.
+        batch_size = latent.shape[0]
+        context = self.batch_context(context, batch_size)
+        unconditional_context = self.batch_context(unconditional_context, batch_size)
         
-        timesteps = np.arange(1, 1000, 1000 // num_steps)
-        alphas = [_ALPHAS_CUMPROD[t] for t in timesteps]    # _ALPHAS_CUMPROD[0] = .99915, _ALPHAS_CUMPROD[999] = .00466
-        alphas_prev = [1.0] + alphas[:-1]
+        timesteps = self.scheduler.set_timesteps(num_steps)
+        schedule = get_schedule(num_steps, dtype=self.dtype)
         idx_time = min(len(timesteps)-1, int(len(timesteps)*input_image_strength))
         #print(num_steps, idx_time, timesteps[idx_time])
         #timesteps = timesteps[: idx_time]
@@ -498,39 +889,58 @@ class StableDiffusion:
         input_mask=None
         
         # Diffusion stage
-        latent_orgin = None
-        mix = None
-        latent_mix =  None
         out_list = []
-        progbar = tqdm(list(enumerate(timesteps))[::-1])
-        for index, timestep in progbar:
-            progbar.set_description(f"{index:3d} {timestep:3d}")
-            
-            if latent_mix is not None:
-                latent = latent_mix
-                
-            e_t = self.get_model_output(
+        if self.can_compile_sampler() and callback is None:
+            latent = self.sample_compiled(
                 latent,
-                timestep,
+                schedule,
                 context,
                 unconditional_context,
                 unconditional_guidance_scale,
-                batch_size,
             )
-            
-            a_t, a_prev = alphas[index], alphas_prev[index]
-            
-            latent, pred_x0 = self.get_x_prev_and_pred_x0(
-                latent, e_t, index, a_t, a_prev)
+        else:
+            for step in self.sample_steps(
+                latent,
+                schedule,
+                context,
+                unconditional_context,
+                unconditional_guidance_scale,
+                batch_size,
+            ):
+                latent = step.latent
+                if callback is not None:
+                    callback(step.index, step.timestep, latent, self.preview_latent(latent, preview == "full"))
 
         decoded = self.decode_latent(latent, input_image_array, input_mask_array, use_auto_mask)
-        out_list.append((decoded[0,:,:,:], ""))
+        for i in range(decoded.shape[0]):
+            out_list.append((decoded[i,:,:,:], ""))
                        
         return out_list
     
-    def decode_latent(self, latent, input_image_array=None, input_mask_array=None, use_auto_mask=False):
+    def decode_raw(self, latent, tile_size=None):
+        # Decoder output in [-1, 1], tiled when the latent is larger than the tile size
+        tile_size = tile_size or self.vae_tile_size
+        if tile_size is None or (
+            latent.shape[1] <= tile_size and latent.shape[2] <= tile_size
+        ):
+            return self.decoder.predict_on_batch(latent)
+
+        if self._tiled_decoder is None:
+            # The inner Decoder layer accepts any spatial size, unlike the Keras model.
+            # Traced once per tile shape: its attention needs static spatial dims.
+            self._tiled_decoder = tf.function(self.decoder.layers[-1])
+        self.last_decode_stats = []
+        return decode_tiled(
+            self._tiled_decoder,
+            latent,
+            tile_size,
+            self.vae_tile_overlap,
+            stats=self.last_decode_stats,
+        )
+
+    def decode_latent(self, latent, input_image_array=None, input_mask_array=None, use_auto_mask=False, tile_size=None):
         # Decoding stage
-        decoded = self.decoder.predict_on_batch(latent)
+        decoded = self.decode_raw(latent, tile_size)
         #print("type(decoded)", type(decoded))   # type(decoded) <class 'numpy.ndarray'>
         #print("decoded.shape", decoded.shape)   # decoded.shape (1, 512, 896, 3)
         decoded = ((decoded + 1) / 2)
@@ -553,41 +963,47 @@ class StableDiffusion:
             
         return np.clip(decoded, 0, 255).astype("uint8")
 
+    def preview_latent(self, latent, full=False, input_image_array=None, input_mask_array=None):
+        # uint8 images of a latent mid-sampling: the full decode_latent, or the
+        # linear approximation at nearly no cost
+        if full:
+            return self.decode_latent(latent, input_image_array, input_mask_array)
+        preview = approximate_decode(latent)
+        if input_image_array is not None and input_mask_array is not None:
+            preview = input_image_array * input_mask_array + preview * (1 - input_mask_array)
+            preview = np.clip(preview, 0, 255).astype("uint8")
+        return preview
+
     def timestep_embedding(self, timesteps, dim=320, max_period=10000):
-        half = dim // 2
-        freqs = np.exp(
-            -math.log(max_period) * np.arange(0, half, dtype="float32") / half
-        )
-        args = np.array(timesteps) * freqs
-        embedding = np.concatenate([np.cos(args), np.sin(args)])
-        return tf.convert_to_tensor(embedding.reshape(1, -1),dtype=self.dtype)
+        # One row per timestep
+        embedding = timestep_embedding(timesteps, dim, max_period)
+        return tf.convert_to_tensor(embedding, dtype=self.dtype)
 
     def add_noise(self, latent , t , noise = None):
         batch_size,w,h = latent.shape[0] , latent.shape[1] , latent.shape[2]
         if noise is None:
             noise = tf.random.normal((batch_size,w,h,4), dtype=self.dtype)
-        # _ALPHAS_CUMPROD[0] = .99915, _ALPHAS_CUMPROD[999] = .00466
-        sqrt_alpha_prod = _ALPHAS_CUMPROD[t] ** 0.5
-        sqrt_one_minus_alpha_prod = (1 - _ALPHAS_CUMPROD[t]) ** 0.5
-        return  sqrt_alpha_prod * latent + sqrt_one_minus_alpha_prod * noise
+        return self.scheduler.add_noise(latent, noise, t)
 
-    def get_starting_parameters(self, timesteps, batch_size, seed, input_image=None, input_img_noise_t=None, noise = None):
+    def get_starting_parameters(self, timesteps, batch_size, seed, input_image=None, input_img_noise_t=None, noise = None, input_latent=None):
+        # input_latent: the already encoded input_image, e.g. from image_latent
         n_h = self.img_height // 8
         n_w = self.img_width // 8
-        alphas = [_ALPHAS_CUMPROD[t] for t in timesteps]    # _ALPHAS_CUMPROD[0] = .99915, _ALPHAS_CUMPROD[999] = .00466
-        alphas_prev = [1.0] + alphas[:-1]
-        if input_image is None:
+        alphas, alphas_prev = get_alphas(tuple(timesteps))
+        if input_image is None and input_latent is None:
             if noise is None:
-                latent = tf.random.normal((batch_size, n_h, n_w, 4), seed=seed)
+                latent = self.latent_noise(seed, batch_size)
             else:
                 latent = noise
         else:
             # input_image is -1 to 1
             #print("get_starting_parameters:input_image shape", input_image.shape)
-            latent = self.encoder(input_image)
+            latent = input_latent if input_latent is not None else self.encode(input_image)
             #print("latent after encode shape", latent.shape)
             latent = tf.repeat(latent , batch_size , axis=0)
             #print("latent after batch_size shape", latent.shape)
+            if noise is None:
+                noise = self.latent_noise(seed, batch_size)
             latent = self.add_noise(latent, input_img_noise_t, noise)
         return latent, alphas, alphas_prev
 
@@ -599,76 +1015,234 @@ class StableDiffusion:
         unconditional_context,
         unconditional_guidance_scale,
         batch_size,
+        t_emb=None,
     ):
-        timesteps = np.array([t])
-        t_emb = self.timestep_embedding(timesteps)
-        t_emb = np.repeat(t_emb, batch_size, axis=0)
-        unconditional_latent = self.diffusion_model.predict_on_batch(
-            [latent, t_emb, unconditional_context]
-        )
-        latent = self.diffusion_model.predict_on_batch([latent, t_emb, context])
+        # t is a timestep, or one per sample so samples at different points of
+        # their schedules share the forward pass. t_emb: precomputed embedding
+        # of t, e.g. a row of DiffusionSchedule.t_embs, or one row per sample.
+        # The guidance scale is a scalar or one value per sample.
+        if t_emb is None:
+            t_emb = self.timestep_embedding(np.atleast_1d(t))
+        t_emb = tf.reshape(t_emb, (-1, t_emb.shape[-1]))
+        if t_emb.shape[0] == 1:
+            t_emb = tf.repeat(t_emb, batch_size, axis=0)
+        unconditional_guidance_scale = per_sample(unconditional_guidance_scale)
+        if self.batch_cfg:
+            # Stack [cond, uncond] along the batch axis for a single forward pass
+            n = latent.shape[0]
+            out = self.diffusion_model.predict_on_batch(
+                [
+                    tf.concat([latent, latent], axis=0),
+                    tf.concat([t_emb, t_emb], axis=0),
+                    tf.concat([context, unconditional_context], axis=0),
+                ]
+            )
+            latent, unconditional_latent = out[:n], out[n:]
+        else:
+            unconditional_latent = self.diffusion_model.predict_on_batch(
+                [latent, t_emb, unconditional_context]
+            )
+            latent = self.diffusion_model.predict_on_batch([latent, t_emb, context])
         return unconditional_latent + unconditional_guidance_scale * (
             latent - unconditional_latent
         )
 
     def get_x_prev_and_pred_x0(self, x, e_t, index, a_t, a_prev):
-        sqrt_one_minus_at = math.sqrt(1 - a_t)
-        pred_x0 = (x - sqrt_one_minus_at * e_t) / math.sqrt(a_t)
+        # Deterministic DDIM step; a_t and a_prev are scalars or one value per sample
+        return ddim_step(x, e_t, per_sample(a_t), per_sample(a_prev))
+
+    def can_compile_sampler(self):
+        # The compiled loop implements deterministic DDIM only
+        return (
+            self.compiled_sampler
+            and isinstance(self.scheduler, DDIMScheduler)
+            and self.scheduler.eta == 0
+        )
+
+    def sample_compiled(
+        self,
+        latent,
+        schedule,
+        context,
+        unconditional_context,
+        unconditional_guidance_scale,
+        jit_compile=None,
+    ):
+        # Graph-mode equivalent of the eager DDIM loop; the eager loop is the reference
+        if jit_compile is None:
+            jit_compile = self.jit_compile
+        # Traces capture self.diffusion_model, which is specific to the resolution
+        key = (jit_compile, self.img_height, self.img_width)
+        sampler = self._compiled_samplers.get(key)
+        if sampler is None:
+            sampler = tf.function(
+                self._sample_ddim, jit_compile=jit_compile, reduce_retracing=True
+            )
+            self._compiled_samplers[key] = sampler
+
+        latent = tf.convert_to_tensor(latent)
+        return sampler(
+            latent,
+            schedule.t_embs,
+            tf.cast(schedule.alphas_tensor, latent.dtype),
+            tf.cast(schedule.alphas_prev_tensor, latent.dtype),
+            tf.convert_to_tensor(context),
+            tf.convert_to_tensor(unconditional_context),
+            # A scalar, or one scale per sample shaped (batch, 1, 1, 1)
+            tf.cast(per_sample(unconditional_guidance_scale), latent.dtype),
+        )
+
+    def _sample_ddim(
+        self,
+        latent,
+        t_embs,
+        alphas,
+        alphas_prev,
+        context,
+        unconditional_context,
+        unconditional_guidance_scale,
+    ):
+        batch_size = tf.shape(latent)[0]
 
-        sigma_t = 0
-        dir_xt = math.sqrt(1.0 - a_prev - sigma_t**2) * e_t # Direction pointing to x_t
-        x_prev = math.sqrt(a_prev) * pred_x0 + dir_xt
-        return x_prev, pred_x0
+        def body(index, latent):
+            t_emb = tf.repeat(t_embs[index][None], batch_size, axis=0)
+            if self.batch_cfg:
+                out = self.diffusion_model(
+                    [
+                        tf.concat([latent, latent], axis=0),
+                        tf.concat([t_emb, t_emb], axis=0),
+                        tf.concat([context, unconditional_context], axis=0),
+                    ],
+                    training=False,
+                )
+                cond_latent, unconditional_latent = out[:batch_size], out[batch_size:]
+            else:
+                unconditional_latent = self.diffusion_model(
+                    [latent, t_emb, unconditional_context], training=False
+                )
+                cond_latent = self.diffusion_model([latent, t_emb, context], training=False)
+            e_t = unconditional_latent + unconditional_guidance_scale * (
+                cond_latent - unconditional_latent
+            )
+            e_t = tf.cast(e_t, latent.dtype)
+
+            a_t, a_prev = alphas[index], alphas_prev[index]
+            pred_x0 = (latent - tf.sqrt(1 - a_t) * e_t) / tf.sqrt(a_t)
+            x_prev = tf.sqrt(a_prev) * pred_x0 + tf.sqrt(1.0 - a_prev) * e_t
+            return index - 1, tf.ensure_shape(x_prev, latent.shape)
 
-def get_models(img_height, img_width, download_weights=True):
-    n_h = img_height // 8
-    n_w = img_width // 8
+        _, latent = tf.while_loop(
+            lambda index, latent: index >= 0,
+            body,
+            (tf.shape(t_embs)[0] - 1, latent),
+        )
+        return latent
 
+def token_windows(inputs, window=MAX_TEXT_LEN - 2):
+    # Splits tokenizer.encode output into rows of MAX_TEXT_LEN ids: up to
+    # `window` prompt tokens between start and end tokens, padded with end tokens
+    if len(inputs) <= MAX_TEXT_LEN:
+        return [list(inputs) + [49407] * (MAX_TEXT_LEN - len(inputs))]
+    tokens = inputs[1:-1]
+    windows = []
+    for start in range(0, len(tokens), window):
+        chunk = [49406] + tokens[start : start + window] + [49407]
+        windows.append(chunk + [49407] * (MAX_TEXT_LEN - len(chunk)))
+    return windows
+
+
+def get_text_encoder():
     # Create text encoder
     input_word_ids = keras.layers.Input(shape=(MAX_TEXT_LEN,), dtype="int32")
     input_pos_ids = keras.layers.Input(shape=(MAX_TEXT_LEN,), dtype="int32")
     embeds = CLIPTextTransformer()([input_word_ids, input_pos_ids])
-    text_encoder = keras.models.Model([input_word_ids, input_pos_ids], embeds)
+    return keras.models.Model([input_word_ids, input_pos_ids], embeds)
+
 
+def get_diffusion_model(unet, img_height, img_width):
     # Creation diffusion UNet
-    context = keras.layers.Input((MAX_TEXT_LEN, 768))
+    # Any multiple of MAX_TEXT_LEN tokens, see StableDiffusion.context_from_inputs
+    context = keras.layers.Input((None, 768))
     t_emb = keras.layers.Input((320,))
-    latent = keras.layers.Input((n_h, n_w, 4))
-    unet = UNetModel()
-    diffusion_model = keras.models.Model(
-        [latent, t_emb, context], unet([latent, t_emb, context])
-    )
+    latent = keras.layers.Input((img_height // 8, img_width // 8, 4))
+    return keras.models.Model([latent, t_emb, context], unet([latent, t_emb, context]))
+
 
+def get_decoder(decoder, img_height, img_width):
     # Create decoder
-    latent = keras.layers.Input((n_h, n_w, 4))
-    decoder = Decoder()
-    decoder = keras.models.Model(latent, decoder(latent))
+    latent = keras.layers.Input((img_height // 8, img_width // 8, 4))
+    return keras.models.Model(latent, decoder(latent))
+
 
+def get_encoder(encoder, img_height, img_width):
     inp_img = keras.layers.Input((img_height, img_width, 3))
-    encoder = Encoder()
-    encoder = keras.models.Model(inp_img, encoder(inp_img))
+    return keras.models.Model(inp_img, encoder(inp_img))
+
+
+def get_resolution_models(unet, decoder, encoder, img_height, img_width):
+    # Keras models for one image size around UNet, Decoder and Encoder layers.
+    # Calling this again with the same layers shares their weights.
+    return (
+        get_diffusion_model(unet, img_height, img_width),
+        get_decoder(decoder, img_height, img_width),
+        get_encoder(encoder, img_height, img_width),
+    )
+
+
+COMPONENTS = ("text_encoder", "diffusion_model", "decoder", "encoder")
+
+# Wrap a UNetModel, Decoder or Encoder layer in a Keras model for one image size
+RESOLUTION_BUILDERS = {
+    "diffusion_model": get_diffusion_model,
+    "decoder": get_decoder,
+    "encoder": get_encoder,
+}
 
+_COMPONENT_LAYERS = {
+    "diffusion_model": UNetModel,
+    "decoder": Decoder,
+    "encoder": Encoder,
+}
+
+
+def build_component(name, img_height, img_width, attention_chunk_size=None):
+    if name == "text_encoder":
+        return get_text_encoder()
+    layer = _COMPONENT_LAYERS[name](attention_chunk_size)
+    return RESOLUTION_BUILDERS[name](layer, img_height, img_width)
+
+
+def load_component(name, img_height, img_width, download_weights=True, attention_chunk_size=None, weights_dir=None, timings=None):
+    model = timed(
+        timings, name, "build", build_component, name, img_height, img_width, attention_chunk_size
+    )
     if download_weights:
-        text_encoder_weights_fpath = keras.utils.get_file(
-            origin="https://huggingface.co/fchollet/stable-diffusion/resolve/main/text_encoder.h5",
-            file_hash="d7805118aeb156fc1d39e38a9a082b05501e2af8c8fbdc1753c9cb85212d6619",
-        )
-        diffusion_model_weights_fpath = keras.utils.get_file(
-            origin="https://huggingface.co/fchollet/stable-diffusion/resolve/main/diffusion_model.h5",
-            file_hash="a5b2eea58365b18b40caee689a2e5d00f4c31dbcb4e1d58a9cf1071f55bbbd3a",
-        )
-        decoder_weights_fpath = keras.utils.get_file(
-            origin="https://huggingface.co/fchollet/stable-diffusion/resolve/main/decoder.h5",
-            file_hash="6d3c5ba91d5cc2b134da881aaa157b2d2adc648e5625560e3ed199561d0e39d5",
-        )
+        source = timed(timings, name, "load", load_weights, model, name, weights_dir)
+        if timings is not None:
+            timings[name]["source"] = source
+    return model
+
 
-        encoder_weights_fpath = keras.utils.get_file(
-            origin="https://huggingface.co/divamgupta/stable-diffusion-tensorflow/resolve/main/encoder_newW.h5",
-            file_hash="56a2578423c640746c5e90c0a789b9b11481f47497f817e65b44a1a5538af754",
+def get_models(img_height, img_width, download_weights=True, attention_chunk_size=None, weights_dir=None, timings=None):
+    # weights_dir: where converted, memory-mappable weights are read from, or
+    # written to after the first load from .h5 (None: always use the .h5 files).
+    # timings: optional dict filled with per-component build/load seconds.
+    return tuple(
+        load_component(
+            name,
+            img_height,
+            img_width,
+            download_weights=download_weights,
+            attention_chunk_size=attention_chunk_size,
+            weights_dir=weights_dir,
+            timings=timings,
         )
+        for name in COMPONENTS
+    )
+
 
-        text_encoder.load_weights(text_encoder_weights_fpath)
-        diffusion_model.load_weights(diffusion_model_weights_fpath)
-        decoder.load_weights(decoder_weights_fpath)
-        encoder.load_weights(encoder_weights_fpath)
-    return text_encoder, diffusion_model, decoder , encoder
+def convert_weights(weights_dir):
+    # One-time conversion of the .h5 weights into fast-loading ones in weights_dir
+    timings = {}
+    get_models(64, 64, weights_dir=weights_dir, timings=timings)
+    return timings
@@ -0,0 +1,114 @@
+import json
+import os
+import time
+
+import numpy as np
+from tensorflow import keras
+
+# Original Keras .h5 weights, by component name
+WEIGHTS_URLS = {
+    "text_encoder": (
+        "https://huggingface.co/fchollet/stable-diffusion/resolve/main/text_encoder.h5",
+        "d7805118aeb156fc1d39e38a9a082b05501e2af8c8fbdc1753c9cb85212d6619",
+    ),
+    "diffusion_model": (
+        "https://huggingface.co/fchollet/stable-diffusion/resolve/main/diffusion_model.h5",
+        "a5b2eea58365b18b40caee689a2e5d00f4c31dbcb4e1d58a9cf1071f55bbbd3a",
+    ),
+    "decoder": (
+        "https://huggingface.co/fchollet/stable-diffusion/resolve/main/decoder.h5",
+        "6d3c5ba91d5cc2b134da881aaa157b2d2adc648e5625560e3ed199561d0e39d5",
+    ),
+    "encoder": (
+        "https://huggingface.co/divamgupta/stable-diffusion-tensorflow/resolve/main/encoder_newW.h5",
+        "56a2578423c640746c5e90c0a789b9b11481f47497f817e65b44a1a5538af754",
+    ),
+}
+
+# Converted weights: <name>.npy is one flat uint8 blob holding every variable
+# back to back, <name>.json lists the dtype, shape and byte offset of each.
+# The blob is memory-mapped on load, so no parsing happens and only the pages
+# being copied into the variables are read.
+
+
+def flat_weights_paths(weights_dir, name):
+    base = os.path.join(weights_dir, name)
+    return base + ".npy", base + ".json"
+
+
+def has_flat_weights(weights_dir, name):
+    return all(os.path.exists(p) for p in flat_weights_paths(weights_dir, name))
+
+
+def save_flat_weights(model, weights_dir, name):
+    os.makedirs(weights_dir, exist_ok=True)
+    blob_path, index_path = flat_weights_paths(weights_dir, name)
+    weights = model.get_weights()
+
+    index = []
+    offset = 0
+    for w in weights:
+        index.append({"dtype": w.dtype.str, "shape": list(w.shape), "offset": offset})
+        offset += w.nbytes
+
+    blob = np.lib.format.open_memmap(
+        blob_path + ".tmp", mode="w+", dtype=np.uint8, shape=(offset,)
+    )
+    for w, entry in zip(weights, index):
+        blob[entry["offset"] : entry["offset"] + w.nbytes] = np.ascontiguousarray(w).view(
+            np.uint8
+        ).ravel()
+    blob.flush()
+    del blob
+    # Write the index last: a blob without one is never picked up
+    os.replace(blob_path + ".tmp", blob_path)
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(index_path + ".tmp", index_path)
+
+
+def load_flat_weights(model, weights_dir, name):
+    blob_path, index_path = flat_weights_paths(weights_dir, name)
+    with open(index_path) as f:
+        index = json.load(f)
+    if len(index) != len(model.weights):
+        raise ValueError(
+            f"{index_path} holds {len(index)} arrays but the model has "
+            f"{len(model.weights)} weights"
+        )
+
+    blob = np.load(blob_path, mmap_mode="r")
+    weights = []
+    for entry in index:
+        dtype = np.dtype(entry["dtype"])
+        nbytes = dtype.itemsize * int(np.prod(entry["shape"], dtype=np.int64))
+        start = entry["offset"]
+        weights.append(blob[start : start + nbytes].view(dtype).reshape(entry["shape"]))
+    model.set_weights(weights)
+
+
+def load_weights(model, name, weights_dir=None):
+    """Loads a component's weights, preferring converted ones in weights_dir.
+
+    Falls back to the original .h5 file, downloading it if needed, and then
+    converts it into weights_dir (when given) so later starts are fast.
+    Returns "flat" or "h5" depending on the source used.
+    """
+    if weights_dir is not None and has_flat_weights(weights_dir, name):
+        load_flat_weights(model, weights_dir, name)
+        return "flat"
+
+    origin, file_hash = WEIGHTS_URLS[name]
+    model.load_weights(keras.utils.get_file(origin=origin, file_hash=file_hash))
+    if weights_dir is not None:
+        save_flat_weights(model, weights_dir, name)
+    return "h5"
+
+
+def timed(timings, name, key, fn, *args):
+    # Runs fn(*args), recording its duration in timings[name][key] if timings is a dict
+    start = time.perf_counter()
+    result = fn(*args)
+    if timings is not None:
+        timings.setdefault(name, {})[key] = time.perf_counter() - start
+    return result
@@ -1,7 +1,7 @@
 from tensorflow import keras
 from stable_diffusion_tf.stable_diffusion import StableDiffusion
 import argparse
-from PIL import Image
+from stable_diffusion_tf.output import save_image
 
 parser = argparse.ArgumentParser()
 
@@ -74,5 +74,5 @@ img = generator.generate(
     batch_size=1,
     seed=args.seed,
 )
-Image.fromarray(img[0]).save(args.output)
+save_image(img[0], args.output, metadata={"prompt": args.prompt, "seed": args.seed, "steps": args.steps, "scale": args.scale})
 print(f"saved at {args.output}")